@@ -0,0 +1,113 @@
+"""Time the stages of compare.py against two local synthetic HAPI servers.
+
+Usage:
+
+  python benchmark.py --datasets 10000 --parameters 10
+
+Timings for get_all_metadata (cold and warm cache), restructure, normalize,
+add_hashes, compare_metadata, and compare_data are printed and written to
+data-dir/benchmark-self.json.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+
+import compare
+import hapi_server
+
+def cli():
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--datasets', type=int, default=hapi_server.defaults['datasets'])
+  parser.add_argument('--parameters', type=int, default=hapi_server.defaults['parameters'])
+  parser.add_argument('--bins', type=float, default=hapi_server.defaults['bins'])
+  parser.add_argument('--differences', type=float, default=hapi_server.defaults['differences'])
+  parser.add_argument('--data-datasets', type=int, default=20,
+                      help="Number of datasets to time compare_data for (default: %(default)s)")
+  parser.add_argument('--workers', type=int, default=8,
+                      help="s1_workers and s2_workers for get_all_metadata (default: %(default)s)")
+  parser.add_argument('--data-dir', default=None,
+                      help="Directory for cache and results (default: new temporary directory)")
+  return vars(parser.parse_args())
+
+def timer(timings, name, func, *args, **kwargs):
+  start = time.time()
+  result = func(*args, **kwargs)
+  timings[name] = time.time() - start
+  print(f"{name:40s} {timings[name]:10.4f} [s]")
+  return result
+
+def main():
+  args = cli()
+  data_dir = args['data_dir'] or tempfile.mkdtemp(prefix='compare-benchmark-')
+
+  server_opts = {k: args[k] for k in ['datasets', 'parameters', 'bins', 'differences']}
+  server1, url1 = hapi_server.start(variant=1, **server_opts)
+  server2, url2 = hapi_server.start(variant=2, **server_opts)
+
+  # Options not given here have the defaults used by compare.py.
+  config = {"benchmark": {"s1": "s1", "s2": "s2", "url1": url1, "url2": url2}}
+  comparator = compare.Comparator('benchmark', config=config, data_dir=data_dir, mode='exact',
+                                  s1_workers=args['workers'], s2_workers=args['workers'])
+  opts = comparator.opts
+
+  # Findings are not of interest, only the time to produce them.
+  logger = logging.getLogger('compare.benchmark')
+  logger.addHandler(logging.NullHandler())
+  logger.propagate = False
+  logger.setLevel(logging.INFO)
+
+  compare.opts = opts
+  compare.args = comparator.args
+  compare.logger = compare.BufferedLogger(logger)
+
+  timings = {}
+  for cache in ['cold', 'warm']:
+    for s in ['s1', 's2']:
+      url = opts[f'url{s[1]}']
+      datasets = timer(timings, f"get_all_metadata {s} ({cache} cache)",
+                       compare.get_all_metadata, url, s, expire_after={"days": 1},
+                       workers=opts[f'{s}_workers'])
+      if s == 's1':
+        datasets_s1o = datasets
+      else:
+        datasets_s2o = datasets
+
+  datasets_s1 = timer(timings, "restructure s1", compare.restructure, datasets_s1o, 's1')
+  datasets_s2 = timer(timings, "restructure s2", compare.restructure, datasets_s2o, 's2')
+  timer(timings, "normalize s1", compare.normalize, datasets_s1, 's1', opts)
+  timer(timings, "normalize s2", compare.normalize, datasets_s2, 's2', opts)
+  timer(timings, "add_hashes s1", compare.add_hashes, datasets_s1, 's1', opts)
+  timer(timings, "add_hashes s2", compare.add_hashes, datasets_s2, 's2', opts)
+  timer(timings, "compare_metadata", compare.compare_metadata, datasets_s1, datasets_s2, opts)
+
+  dsids = list(datasets_s1.keys())[0:args['data_datasets']]
+  opts['compare_data'] = True
+  transfer = {}
+  for data_format in ['csv', 'binary']:
+    for compress in [True, False]:
+      opts['data_format'] = data_format
+      opts['compress'] = compress
+      compare.transfer.clear()
+      compare.close_data_sessions()
+      def compare_data():
+        for dsid in dsids:
+          compare.compare_data(dsid, datasets_s1, datasets_s2, opts)
+      name = f"compare_data {len(dsids)} datasets ({data_format}{'' if compress else ', no compression'})"
+      timer(timings, name, compare_data)
+      transfer[name] = compare.log_transfer(opts)
+      print(f"{'':40s} {transfer[name]['s1']['wire_bytes']/1e6:10.3f} [MB on the wire]")
+
+  server1.shutdown()
+  server2.shutdown()
+
+  fname = os.path.join(data_dir, 'benchmark-self.json')
+  with open(fname, 'w', encoding='utf-8') as f:
+    json.dump({"options": {**server_opts, **args}, "timings": timings, "transfer": transfer}, f, indent=2)
+  print(f"Wrote {fname}")
+
+if __name__ == '__main__':
+  sys.exit(main())
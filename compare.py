@@ -1,19 +1,36 @@
 import os
-import copy
 import time
 import json
+import zlib
+import random
+import sqlite3
+import hashlib
+import queue
 import datetime
+import functools
+import logging
+import logging.handlers
+import itertools
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import requests
-import requests_cache
 import urllib3
-import deepdiff
 
-from hapiclient import hapitime2datetime
 import utilrsw
 
-def cli(config):
+# numpy, requests_cache, and hapiclient (which imports pandas) are imported in
+# the functions that use them so that importing this module and runs that do
+# not need them start quickly.
+
+def hapitime2datetime(Time):
+  from hapiclient import hapitime2datetime
+  return hapitime2datetime(Time)
+
+def cli(config, argv=None):
   data_dir = os.path.join(os.path.dirname(__file__), 'data')
 
   clkws = {
@@ -28,8 +45,9 @@ def cli(config):
       "default": "update"
     },
     "conf": {
-      "help": "Configuration options to use from compare.json (default: %(default)s)",
-      "default": "CDAWeb",
+      "help": "Configuration(s) to use from compare.json; servers used by more than one are loaded once (default: %(default)s)",
+      "default": ["CDAWeb"],
+      "nargs": "+",
       "choices": list(config.keys())
     },
     "warn": {
@@ -51,6 +69,149 @@ def cli(config):
       "help": "Compare data",
       "default": False
     },
+    "stream": {
+      "action": "store_true",
+      "help": "Read data responses incrementally when comparing data (default: stream in compare.json or False)",
+      "default": None
+    },
+    "data-mode": {
+      "help": "'exact' or 'tolerance'; if 'tolerance', numeric data values are compared using --rtol and --atol (default: data_mode in compare.json or 'exact')",
+      "default": None,
+      "choices": ['exact', 'tolerance']
+    },
+    "data-format": {
+      "help": "HAPI format for data requests, 'csv' or 'binary' (default: data_format in compare.json or 'csv')",
+      "default": None,
+      "choices": ['csv', 'binary']
+    },
+    "rtol": {
+      "help": "Relative tolerance for --data-mode tolerance and bins centers and ranges (default: rtol in compare.json or 1e-7)",
+      "type": float,
+      "default": None
+    },
+    "atol": {
+      "help": "Absolute tolerance for --data-mode tolerance and bins centers and ranges (default: atol in compare.json or 0)",
+      "type": float,
+      "default": None
+    },
+    "jobs": {
+      "help": "Number of datasets to compare in parallel (default: jobs in compare.json or 1)",
+      "type": int,
+      "default": None
+    },
+    "sample-windows": {
+      "help": "Number of time windows of length sample_duration spread from startDate to stopDate to compare (default: sample_windows in compare.json or 1)",
+      "type": int,
+      "default": None
+    },
+    "chunk-workers": {
+      "help": "Number of chunks of a dataset to request in parallel when chunk_duration is given in compare.json (default: chunk_workers in compare.json or 4)",
+      "type": int,
+      "default": None
+    },
+    "benchmark": {
+      "help": "Request data N additional times from each server and write timing statistics to data-dir/benchmark.CONF.{json,csv}; implies --compare-data",
+      "type": int,
+      "default": None
+    },
+    "load": {
+      "help": "Comma-separated numbers of concurrent clients, e.g., 1,2,4,8. If given, run a load test of /info and /data requests against both servers instead of comparing",
+      "default": None
+    },
+    "load-requests": {
+      "help": "Number of requests per server and number of clients in load test (default: load_requests in compare.json or use --load-duration)",
+      "type": int,
+      "default": None
+    },
+    "load-duration": {
+      "help": "Seconds per server and number of clients in load test if --load-requests not given (default: load_duration in compare.json or 10)",
+      "type": float,
+      "default": None
+    },
+    "pool-size": {
+      "help": "Maximum number of kept-alive connections to each server for /data requests (default: pool_size in compare.json or 10)",
+      "type": int,
+      "default": None
+    },
+    "no-compress": {
+      "action": "store_true",
+      "help": "Request /data responses without gzip or deflate compression (default: not compress in compare.json or False)",
+      "default": False
+    },
+    "data-cache-size": {
+      "help": "Maximum size in MB of the cache of /data responses from servers with s1_data_expire_after or s2_data_expire_after in compare.json (default: data_cache_size in compare.json or 1000)",
+      "type": float,
+      "default": None
+    },
+    "metrics": {
+      "help": "Write timing spans, counters, and cache hit ratios of the run to data-dir/metrics.CONF.json or, for prometheus, data-dir/metrics.CONF.prom (default: metrics in compare.json or do not write)",
+      "default": None,
+      "choices": ['json', 'prometheus']
+    },
+    "profile": {
+      "action": "store_true",
+      "help": "Profile the main thread of the run with cProfile, write data-dir/profile.CONF.prof, and log the functions with the most cumulative time (default: profile in compare.json or False)",
+      "default": None
+    },
+    "no-findings": {
+      "action": "store_true",
+      "help": "Do not write findings as JSON lines to data-dir/compare.CONF.findings.jsonl (default: not findings in compare.json or False)",
+      "default": False
+    },
+    "incremental": {
+      "action": "store_true",
+      "help": "Only compare /info metadata of datasets that changed since the previous run (default: incremental in compare.json or False)",
+      "default": None
+    },
+    "cache-backend": {
+      "help": "requests_cache backend for metadata (default: cache_backend in compare.json or 'sqlite')",
+      "default": None,
+      "choices": ['sqlite', 'filesystem']
+    },
+    "shard": {
+      "help": "Compare only datasets in shard i of N, e.g., 2/4, using the catalog snapshots written by --prepare; IDs are assigned to shards by a hash so all runs agree (default: shard in compare.json or all datasets)",
+      "default": None
+    },
+    "prepare": {
+      "action": "store_true",
+      "help": "Get metadata from both servers, write the catalog snapshots read by --shard runs, and exit; with --id, shards with datasets that do not match get their metadata themselves",
+      "default": False
+    },
+    "merge": {
+      "help": "Combine the findings files of --shard 1/N, ..., N/N runs into data-dir/compare.CONF.findings.jsonl in the order of a run without --shard and exit",
+      "type": int,
+      "default": None
+    },
+    "prune": {
+      "action": "store_true",
+      "help": "Remove expired and orphaned entries from the metadata caches and exit",
+      "default": False
+    },
+    "timeout": {
+      "help": "Seconds to wait for a server to connect or send data (default: timeout in compare.json or 60)",
+      "type": float,
+      "default": None
+    },
+    "retries": {
+      "help": "Number of retries of requests that fail with a connection error, timeout, or HTTP 429/502/503/504 (default: retries in compare.json or 3)",
+      "type": int,
+      "default": None
+    },
+    "max-per-host": {
+      "help": "Maximum number of requests in progress to a server; the limit used adapts between 1 and this (default: max_per_host in compare.json or 8)",
+      "type": int,
+      "default": None
+    },
+    "s1-workers": {
+      "help": "Number of concurrent /info requests to s1 (default: s1_workers in compare.json or 1)",
+      "type": int,
+      "default": None
+    },
+    "s2-workers": {
+      "help": "Number of concurrent /info requests to s2 (default: s2_workers in compare.json or 1)",
+      "type": int,
+      "default": None
+    },
     "log-level": {
       "help": "Log level",
       "default": 'info',
@@ -69,18 +230,134 @@ def cli(config):
     parser.add_argument(f'--{k}', **v)
 
   # Note that hyphens are converted to underscores when parsing
-  args = vars(parser.parse_args())
-  if args['conf'] == 'CDAWeb-metadata' and args['compare_data']:
-    raise ValueError("CDAWeb-metadata does not support comparing data.")
-
-  if args['debug']:
-    args['log_level'] = 'debug'
-
-  args['data_dir'] = os.path.abspath(args['data_dir'])
+  args = vars(parser.parse_args(argv))
 
   return args
 
-def _logger(log_level, data_dir, conf_name):
+# Dataset being compared; added to findings. See compare_dataset().
+current_dataset = contextvars.ContextVar('current_dataset', default=None)
+
+class FindingsHandler(logging.Handler):
+  """Write the finding of records that have one as a line of JSON.
+
+  If fname is None, findings are appended to the list self.findings instead.
+  """
+
+  def __init__(self, fname=None):
+    super().__init__()
+    self.file = None
+    self.findings = []
+    if fname is not None:
+      os.makedirs(os.path.dirname(fname), exist_ok=True)
+      self.file = open(fname, 'w', encoding='utf-8')
+
+  def emit(self, record):
+    finding = getattr(record, 'finding', None)
+    if finding is None:
+      return
+    try:
+      finding = {**finding, "severity": record.levelname.lower(), "message": record.getMessage().strip()}
+      if self.file is None:
+        self.findings.append(finding)
+      else:
+        self.file.write(json.dumps(finding, default=str) + "\n")
+    except Exception:
+      self.handleError(record)
+
+  def flush(self):
+    if self.file is not None:
+      self.file.flush()
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+    super().close()
+
+class BufferedLogger:
+  """Wrapper of a logging.Logger that can hold records in a buffer.
+
+  Used so that the output for a dataset is written as one block when datasets
+  are compared in parallel. Outside of a buffered() block, records are
+  handled immediately by the wrapped logger.
+  """
+
+  def __init__(self, logger):
+    self.logger = logger
+    self.records = contextvars.ContextVar('records', default=None)
+
+  def __getattr__(self, name):
+    return getattr(self.logger, name)
+
+  def _log(self, level, msg, *args, finding=None, display=True):
+    enabled = display and self.logger.isEnabledFor(level)
+    if not enabled and finding is None:
+      return
+    extra = None
+    if finding is not None:
+      extra = {"finding": {"dataset": current_dataset.get(), **finding}, "display": display}
+      if not enabled:
+        # Findings do not depend on the log level; only FindingsHandler
+        # handles this record. See displayed().
+        extra["finding_only"] = True
+    records = self.records.get()
+    if records is None and enabled:
+      # stacklevel=3 so filename and lineno are those of the caller of info(), etc.
+      self.logger.log(level, msg, *args, stacklevel=3, extra=extra)
+      return
+    fn, lno, func, sinfo = self.logger.findCaller(stacklevel=3)
+    record = self.logger.makeRecord(self.logger.name, level, fn, lno, msg, args, None, func=func, extra=extra)
+    if records is None:
+      # handle() does not check the level of the logger.
+      self.logger.handle(record)
+    else:
+      records.append(record)
+
+  # finding is a dict with keys of, e.g., parameter, key, val_s1, and val_s2
+  # that is written to the findings file by FindingsHandler. If display is
+  # False, the finding is written but the message is not logged.
+
+  def debug(self, msg, *args, finding=None, display=True):
+    self._log(logging.DEBUG, msg, *args, finding=finding, display=display)
+
+  def info(self, msg, *args, finding=None, display=True):
+    self._log(logging.INFO, msg, *args, finding=finding, display=display)
+
+  def warning(self, msg, *args, finding=None, display=True):
+    self._log(logging.WARNING, msg, *args, finding=finding, display=display)
+
+  def error(self, msg, *args, finding=None, display=True):
+    self._log(logging.ERROR, msg, *args, finding=finding, display=display)
+
+  def critical(self, msg, *args, finding=None, display=True):
+    self._log(logging.CRITICAL, msg, *args, finding=finding, display=display)
+
+  def log(self, level, msg, *args, finding=None, display=True):
+    self._log(level, msg, *args, finding=finding, display=display)
+
+  @contextlib.contextmanager
+  def buffered(self):
+    """Buffer records logged in this context; yields the list of records."""
+    records = []
+    token = self.records.set(records)
+    try:
+      yield records
+    finally:
+      self.records.reset(token)
+
+  def flush(self, records):
+    """Handle records, or add them to the active buffer if there is one."""
+    records_active = self.records.get()
+    if records_active is not None:
+      records_active.extend(records)
+      return
+    for record in records:
+      self.logger.handle(record)
+
+def displayed(record):
+  """Filter of handlers other than FindingsHandler; see BufferedLogger._log()."""
+  return not getattr(record, 'finding_only', False)
+
+def _logger(log_level, data_dir, conf_name, findings=True):
   logger_ = {
       "name": "compare",
       "file_log": f"{data_dir}/compare.{conf_name}.log",
@@ -93,22 +370,106 @@ def _logger(log_level, data_dir, conf_name):
   if log_level.lower() == 'debug':
     logger_["console_format"] = "%(name)s %(levelname)s %(filename)s:%(lineno)d %(message)s"
 
-  logger = utilrsw.logger(**logger_)
-  logger.setLevel(args['log_level'].upper())
+  # In case a previous logger was not closed.
+  close_logger(logging.getLogger(logger_['name']))
 
-  return logger
+  logger = utilrsw.logger(**logger_)
+  logger.setLevel(log_level.upper())
+
+  handlers = list(logger.handlers)
+  for handler in handlers:
+    handler.addFilter(displayed)
+  if findings:
+    handlers.append(FindingsHandler(f"{data_dir}/compare.{conf_name}.findings.jsonl"))
+
+  # Formatting and writing of records is done by the handlers in a background
+  # thread so that logging does not block comparisons.
+  log_queue = queue.SimpleQueue()
+  for handler in logger.handlers.copy():
+    logger.removeHandler(handler)
+  logger.addHandler(logging.handlers.QueueHandler(log_queue))
+  listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+  listener.start()
+  logger.listener = listener
+
+  return BufferedLogger(logger)
+
+def close_logger(logger):
+  """Write queued records, then stop the listener and close the handlers
+  started by _logger()."""
+  listener = getattr(logger, 'listener', None)
+  if listener is not None:
+    listener.stop()
+    for handler in listener.handlers:
+      handler.close()
+    logger.listener = None
+  for handler in logger.handlers.copy():
+    logger.removeHandler(handler)
 
 def omit(id):
   # TODO: This is a copy of function in cdaweb.py. Move to a common module.
   import re
   if id == 'AIM_CIPS_SCI_3A':
     return True
-  if opts['id'] is not None:
-    if re.search(opts['id'], id):
-      return False
+  if opts['id'] is not None and not re.search(opts['id'], id):
     return True
-  else:
-    return False
+  if opts['shard'] is not None:
+    return shard(id, opts['shard'][1]) != opts['shard'][0]
+  return False
+
+def shard(id, n):
+  """Return the shard, 1 to n, of dataset id.
+
+  crc32 is used b/c hash() is randomized per process.
+  """
+  return zlib.crc32(id.encode('utf-8')) % n + 1
+
+def shard_name(conf, i, n):
+  return f"{conf}.shard-{i}-of-{n}"
+
+def merge_findings(opts):
+  """Combine the findings files of shards 1 to opts['merge'].
+
+  Findings are logged, and so written to the findings file of this run, in
+  the order of a run without --shard: datasets not in s1 in s2 catalog order,
+  then the findings of each dataset in s1 catalog order. Catalog order is
+  that of the snapshots written by --prepare.
+  """
+
+  n = opts['merge']
+  order = {}
+  for s in ['s1', 's2']:
+    fname_index = snapshot_files(opts[f'url{s[1]}'])[1]
+    if not os.path.exists(fname_index):
+      logger.error(f"No {opts[s]} catalog snapshot {fname_index}; cannot order findings. Use --prepare.")
+      return
+    with open(fname_index, 'r', encoding='utf-8') as f:
+      order[s] = {id: k for k, id in enumerate(json.load(f)['catalog'])}
+
+  findings = []
+  for i in range(1, n + 1):
+    fname = f"{opts['data_dir']}/compare.{shard_name(opts['conf'], i, n)}.findings.jsonl"
+    if not os.path.exists(fname):
+      logger.error(f"No findings file for shard {i} of {n}: {fname}")
+      return
+    with open(fname, 'r', encoding='utf-8') as f:
+      findings.extend(json.loads(line) for line in f)
+    logger.info(f"Read {fname}")
+
+  def key(finding):
+    dsid = finding.get('dataset', None)
+    if dsid is None:
+      return (0, 0)
+    if finding.get('key', None) == 'id' and finding.get('val_s1', '') is None:
+      return (1, order['s2'].get(dsid, len(order['s2'])))
+    return (2, order['s1'].get(dsid, len(order['s1'])))
+
+  # sorted() is stable, so the findings of a dataset keep their order.
+  for finding in sorted(findings, key=key):
+    level = logging.getLevelName(finding.pop('severity').upper())
+    msg = finding.pop('message')
+    logger.log(level, msg, finding=finding)
+  logger.info(f"Merged {len(findings)} findings from {n} shards")
 
 def compare_metadata(datasets_s1, datasets_s2, opts):
 
@@ -123,134 +484,227 @@ def compare_metadata(datasets_s1, datasets_s2, opts):
       if opts['mode'] == 'update':
         if opts['warn']:
           logger.info(f"{dsid}")
-          logger.warning(indent + msg)
+        logger.warning(indent + msg, finding={"dataset": dsid, "key": "id", "val_s1": None, "val_s2": dsid}, display=opts['warn'])
       else:
         logger.info(f"{dsid}")
-        logger.error(indent + msg)
+        logger.error(indent + msg, finding={"dataset": dsid, "key": "id", "val_s1": None, "val_s2": dsid})
       dsid0 = dsid + "@0"
       if dsid[-2] != "@" and dsid0 in list(datasets_s1.keys()):
         logger.error(f"{indent}But {dsid0} in {opts['s1']}")
 
-  for dsid in datasets_s1.keys():
+  dsids = [dsid for dsid in datasets_s1.keys() if not omit(dsid)]
+
+  state = None
+  if opts['incremental']:
+    state = read_state(opts)
+  replayed = []
+
+  def compare_dataset_buffered(dsid):
+    fingerprint = [datasets_s1[dsid].get("_hash", None), None]
+    if dsid in datasets_s2:
+      fingerprint[1] = datasets_s2[dsid].get("_hash", None)
+
+    with logger.buffered() as records:
+      entry = None
+      if state is not None and opts['compare_data'] is False:
+        # Data may change even if /info does not, so findings are only
+        # replayed when data is not compared.
+        entry = state['datasets'].get(dsid, None)
+      if entry is not None and entry['fingerprint'] == fingerprint:
+        for levelno, msg, args, finding, display in entry['findings']:
+          logger.log(levelno, msg, *args, finding=finding, display=display)
+        replayed.append(dsid)
+      else:
+        compare_dataset(dsid, datasets_s1, datasets_s2, opts)
 
-    if omit(dsid):
-      continue
+    if state is not None:
+      findings = [[r.levelno, r.msg, list(r.args), getattr(r, 'finding', None), getattr(r, 'display', True)] for r in records]
+      state['datasets'][dsid] = {'fingerprint': fingerprint, 'findings': findings}
 
-    logger.info(f"{dsid}")
+    return records
 
-    extra = ""
-    if "x_cdf_depend_0_name" in datasets_s1[dsid]["info"]["parameters"][0]:
-      # Special case for when s1 = 'bw'
-      x_cdf_depend_0_name = datasets_s1[dsid]["info"]["parameters"][0]["x_cdf_depend_0_name"]
-      extra = f'for s1 DEPEND_0 = {x_cdf_depend_0_name}'
+  if opts['jobs'] > 1:
+    # map() returns results in the order of dsids, so each dataset's output is
+    # written as one block in catalog order as soon as it and all datasets
+    # before it are done.
+    with ThreadPoolExecutor(max_workers=opts['jobs']) as pool:
+      for records in pool.map(compare_dataset_buffered, dsids):
+        logger.flush(records)
+  else:
+    for dsid in dsids:
+      if state is None:
+        compare_dataset(dsid, datasets_s1, datasets_s2, opts)
+      else:
+        logger.flush(compare_dataset_buffered(dsid))
+
+  if state is not None:
+    n = len(replayed)
+    logger.info(f"Replayed findings for {n} of {len(dsids)} datasets unchanged since previous run")
+    write_state(state, opts)
+
+def state_options(opts):
+  """Options that affect findings; state is discarded if any change."""
+  # compare_data b/c findings of a dataset include those of its data; rtol
+  # and atol b/c bins and data values are compared using them.
+  keys = ['s1', 's2', 'url1', 'url2', 'mode', 'warn', 's1_omits', 's2_omits', 'findings',
+          'compare_data', 'rtol', 'atol']
+  return {key: opts.get(key, None) for key in keys}
+
+def read_state(opts):
+  """Read per-dataset fingerprints and findings from the previous run."""
+  fname = f"{opts['data_dir']}/cache/state.{opts['name']}.json"
+  state = {'options': state_options(opts), 'datasets': {}}
+  if not os.path.exists(fname):
+    logger.info(f"No previous state file {fname}; comparing all datasets")
+    return state
+  state_last = utilrsw.read(fname, logger=logger)
+  if state_last.get('options', None) != state['options']:
+    logger.info(f"Options changed since previous run; not using {fname}")
+    return state
+  return state_last
+
+def write_state(state, opts):
+  fname = f"{opts['data_dir']}/cache/state.{opts['name']}.json"
+  utilrsw.write(fname, state, logger=logger)
+
+def compare_dataset(dsid, datasets_s1, datasets_s2, opts):
+
+  current_dataset.set(dsid)
+  count('datasets')
 
-    if dsid not in datasets_s2:
+  indent = '  '
 
-      logger.error(f"{indent}{dsid} not in {opts['s2']} {extra}")
-      dsid0 = dsid + "@0"
-      if dsid[-2] != "@" and dsid0 in list(datasets_s2.keys()):
-        logger.error(f"{indent}But {dsid0} in {opts['s2']}")
+  logger.info(f"{dsid}")
 
-    else:
+  extra = ""
+  if "x_cdf_depend_0_name" in datasets_s1[dsid]["info"]["parameters"][0]:
+    # Special case for when s1 = 'bw'
+    x_cdf_depend_0_name = datasets_s1[dsid]["info"]["parameters"][0]["x_cdf_depend_0_name"]
+    extra = f'for s1 DEPEND_0 = {x_cdf_depend_0_name}'
 
-      compare_info(dsid, datasets_s2[dsid]["info"], datasets_s1[dsid]["info"])
+  if dsid not in datasets_s2:
 
-      keys_s2 = datasets_s2[dsid]["info"]["_parameters"].keys()
-      keys_s1 = datasets_s1[dsid]["info"]["_parameters"].keys()
+    finding = {"key": "id", "val_s1": dsid, "val_s2": None}
+    logger.error(f"{indent}{dsid} not in {opts['s2']} {extra}", finding=finding)
+    dsid0 = dsid + "@0"
+    if dsid[-2] != "@" and dsid0 in list(datasets_s2.keys()):
+      logger.error(f"{indent}But {dsid0} in {opts['s2']}")
 
-      n_params_s2 = len(keys_s2)
-      n_params_s1 = len(keys_s1)
+  else:
 
-      if n_params_s2 != n_params_s1:
-        m = min(n_params_s2, n_params_s1)
-        if list(keys_s1)[0:m] != list(keys_s2)[0:m]:
-          logger.error(f"{indent}n_params_{opts['s2']} = {n_params_s2} != n_params_{opts['s1']} = {n_params_s1} {extra}")
-          logger.error(f"{2*indent}Differences: {set(keys_s1) ^ set(keys_s2)}")
-          logger.error(f"{2*indent}Error because first {m} parameters are not identical.")
+    # Before the check of hashes b/c an invalid reference is an error even if
+    # both servers have it.
+    for s, datasets in [('s1', datasets_s1), ('s2', datasets_s2)]:
+      check_bins_references(datasets[dsid]["info"], opts[s])
+
+    hash_s1 = datasets_s1[dsid].get("_hash", None)
+    if hash_s1 is not None and hash_s1 == datasets_s2[dsid].get("_hash", None):
+      # Compared /info content is identical, so compare_info, compare_parameter,
+      # and compare_bins would not find differences.
+      logger.debug(f"{indent}/info metadata is the same")
+      compare_data(dsid, datasets_s1, datasets_s2, opts)
+      return
+
+    compare_info(dsid, datasets_s2[dsid]["info"], datasets_s1[dsid]["info"])
+
+    keys_s2 = datasets_s2[dsid]["info"]["_parameters"].keys()
+    keys_s1 = datasets_s1[dsid]["info"]["_parameters"].keys()
+
+    n_params_s2 = len(keys_s2)
+    n_params_s1 = len(keys_s1)
+
+    if n_params_s2 != n_params_s1:
+      m = min(n_params_s2, n_params_s1)
+      if list(keys_s1)[0:m] != list(keys_s2)[0:m]:
+        finding = {"key": "parameters", "val_s1": list(keys_s1), "val_s2": list(keys_s2)}
+        logger.error(f"{indent}n_params_{opts['s2']} = {n_params_s2} != n_params_{opts['s1']} = {n_params_s1} {extra}", finding=finding)
+        logger.error(f"{2*indent}Differences: {set(keys_s1) ^ set(keys_s2)}")
+        logger.error(f"{2*indent}Error because first {m} parameters are not identical.")
+      else:
+        msgo = f"{2*indent}n_params_{opts['s2']} = {n_params_s2} > n_params_{opts['s1']} = {n_params_s1}. {extra}"
+        msgw = f"{3*indent}Warning b/c first {m} parameters are same & mode = 'update'"
+        msgx = f"{3*indent}Differences: {set(keys_s1) ^ set(keys_s2)}"
+        finding = {"key": "parameters", "val_s1": list(keys_s1), "val_s2": list(keys_s2)}
+        if n_params_s2 > n_params_s1:
+          if opts['mode'] != 'update':
+            logger.error(msgo, finding=finding)
+            logger.error(msgx)
+          else:
+            logger.warning(msgo, finding=finding)
+            logger.warning(msgw)
+            logger.warning(msgx)
         else:
-          msgo = f"{2*indent}n_params_{opts['s2']} = {n_params_s2} > n_params_{opts['s1']} = {n_params_s1}. {extra}"
-          msgw = f"{3*indent}Warning b/c first {m} parameters are same & mode = 'update'"
-          msgx = f"{3*indent}Differences: {set(keys_s1) ^ set(keys_s2)}"
-          if n_params_s2 > n_params_s1:
-            if opts['mode'] != 'update':
-              logger.error(msgo)
-              logger.error(msgx)
-            else:
-              logger.warning(msgo)
-              logger.warning(msgw)
-              logger.warning(msgx)
+          msgo = msgo.replace(" > ", " < ")
+          if opts['mode'] != 'update':
+            logger.error(msgo, finding=finding)
+            logger.error(msgx)
           else:
-            msgo = msgo.replace(" > ", " < ")
-            if opts['mode'] != 'update':
-              logger.error(msgo)
-              logger.error(msgx)
-            else:
-              logger.warning(msgo)
-              logger.warning(msgw)
-              logger.warning(msgx)
+            logger.warning(msgo, finding=finding)
+            logger.warning(msgw)
+            logger.warning(msgx)
 
-          parameters = list(keys_s1)[0:m]
-          compare_data(dsid, datasets_s1, datasets_s2, opts, parameters=parameters)
+        parameters = list(keys_s1)[0:m]
+        compare_data(dsid, datasets_s1, datasets_s2, opts, parameters=parameters)
+    else:
+      # As lists b/c dict_keys compare as sets, i.e., ignore order.
+      if list(keys_s2) != list(keys_s1):
+        finding = {"key": "parameters", "val_s1": list(keys_s1), "val_s2": list(keys_s2)}
+        logger.error(f'{indent}Order differs {extra}', finding=finding)
+        logger.error(f"{2*indent}{opts['s2_padded']}: {list(keys_s2)}")
+        logger.error(f"{2*indent}{opts['s1_padded']}: {list(keys_s1)}")
       else:
-        if keys_s2 != keys_s1:
-          logger.error(f'{indent}Order differs {extra}','fail')
-          logger.error(f"{2*indent}{opts['s2_padded']}: {list(keys_s2)}",'info')
-          logger.error(f"{2*indent}{opts['s1_padded']}: {list(keys_s1)}",'info')
-        else:
-          for i in range(len(datasets_s2[dsid]["info"]["parameters"])):
-            param_s2 = datasets_s2[dsid]["info"]["parameters"][i]
-            param_s1 = datasets_s1[dsid]["info"]["parameters"][i]
-            compare_parameter(dsid, param_s2, param_s1)
+        norms_s2 = datasets_s2[dsid]["info"]["_normalized"]["parameters"]
+        norms_s1 = datasets_s1[dsid]["info"]["_normalized"]["parameters"]
+        for i in range(len(datasets_s2[dsid]["info"]["parameters"])):
+          param_s2 = datasets_s2[dsid]["info"]["parameters"][i]
+          param_s1 = datasets_s1[dsid]["info"]["parameters"][i]
+          compare_parameter(dsid, param_s2, param_s1, norms_s2[i], norms_s1[i])
+          compare_bins(param_s2, param_s1)
 
-          compare_data(dsid, datasets_s1, datasets_s2, opts)
+        compare_data(dsid, datasets_s1, datasets_s2, opts)
 
 def compare_info(dsid, info_s2, info_s1):
 
   indent = "  "
-  keys_s1 = list(info_s1.keys())
-  keys_s2 = list(info_s2.keys())
-
-  keys_s1 = remove_keys(keys_s1, 's1', opts)
-  keys_s2 = remove_keys(keys_s2, 's2', opts)
+  keys_s1 = info_s1['_normalized']['keys']
+  keys_s2 = info_s2['_normalized']['keys']
 
   n_keys_s2 = len(keys_s2)
   n_keys_s1 = len(keys_s1)
 
   if n_keys_s2 != n_keys_s1:
-    logger.error(f'{indent}n_keys_{opts["s2"]} = {n_keys_s2} != n_keys_{opts["s1"]} = {n_keys_s1}')
+    finding = {"key": "keys", "val_s1": keys_s1, "val_s2": keys_s2}
+    logger.error(f'{indent}n_keys_{opts["s2"]} = {n_keys_s2} != n_keys_{opts["s1"]} = {n_keys_s1}', finding=finding)
     logger.error(f"{2*indent}Differences: {set(keys_s1) ^ set(keys_s2)}")
   else:
-    common_keys = set(keys_s2) & set(keys_s1)
+    # In order of keys_s2, not a set, so findings are in the same order in
+    # every run.
+    keys_s1_set = set(keys_s1)
+    common_keys = [key for key in keys_s2 if key in keys_s1_set]
     for key in common_keys:
       if info_s2[key] != info_s1[key]:
+        finding = {"key": key, "val_s1": info_s1[key], "val_s2": info_s2[key]}
         if key.endswith('Date'):
-          date1 = hapitime2datetime(info_s1[key])[0]
-          date2 = hapitime2datetime(info_s2[key])[0]
-          if date1 != date2:
+          date1 = info_s1['_normalized']['dates'].get(key, None)
+          date2 = info_s2['_normalized']['dates'].get(key, None)
+          if date1 is None or date1 != date2:
             msg = f'{indent}{key} (datetime comparison) val_{opts["s2"]} = {info_s2[key]} '
-            msg += '!= val_{opts["s1"]} = {info_s1[key]}'
-            logger.error(msg)
-          elif args['warn']:
+            msg += f'!= val_{opts["s1"]} = {info_s1[key]}'
+            logger.error(msg, finding=finding)
+          else:
             msg = f'{indent}{key} val_{opts["s2"]} = {info_s2[key]} != '
-            msg += 'val_{opts["s1"]} = {info_s1[key]} but datetime equivalent.'
-            logger.warning(msg)
+            msg += f'val_{opts["s1"]} = {info_s1[key]} but datetime equivalent.'
+            logger.warning(msg, finding=finding, display=opts['warn'])
         else:
           msg = f'{indent}{key} val_{opts["s2"]} = {info_s2[key]} != val_{opts["s1"]} = {info_s1[key]}'
-          logger.error(msg)
+          logger.error(msg, finding=finding)
 
-def compare_parameter(dsid, param_s2, param_s1):
+def compare_parameter(dsid, param_s2, param_s1, norm_s2, norm_s1):
+  """Compare parameter objects; norm_s1 and norm_s2 are from normalize_parameter()."""
 
   indent = "  "
-  param_s1_keys = sorted(list(param_s1.keys()))
-  param_s2_keys = sorted(list(param_s2.keys()))
-
-  for key in param_s1_keys.copy():
-    if key.startswith("x_"):
-      param_s1_keys.remove(key)
-
-  for key in param_s2_keys.copy():
-    if key.startswith("x_"):
-      param_s2_keys.remove(key)
+  param_s1_keys = norm_s1['keys']
+  param_s2_keys = norm_s2['keys']
 
   n_param_keys_s1 = len(param_s1_keys)
   n_param_keys_s2 = len(param_s2_keys)
@@ -259,7 +713,8 @@ def compare_parameter(dsid, param_s2, param_s1):
       logger.info(f"{param_s2['name']}")
       msg = f"{2*indent}n_param_keys_{opts['s2']} = {n_param_keys_s2} != "
       msg += "n_param_keys_{opts['s1']} = {n_param_keys_s1}"
-      logger.error(msg)
+      finding = {"parameter": param_s2['name'], "key": "keys", "val_s1": param_s1_keys, "val_s2": param_s2_keys}
+      logger.error(msg, finding=finding)
       logger.error(f"{3*indent}Differences: {set(param_s1_keys) ^ set(param_s2_keys)}")
 
   common_keys = set(param_s2_keys) & set(param_s1_keys)
@@ -270,28 +725,29 @@ def compare_parameter(dsid, param_s2, param_s1):
       continue
     if param_s2[key] != param_s1[key]:
       msgo = f"{indent}{param_s2['name']}/{key}"
+      finding = {"parameter": param_s2['name'], "key": key, "val_s1": param_s1[key], "val_s2": param_s2[key]}
       if key == 'fill' and 'type' in param_s2 and 'type' in param_s1:
         a = (param_s2['type'] == 'int' or param_s2['type'] == 'double')
         b = (param_s1['type'] == 'int' or param_s1['type'] == 'double')
         if a and b:
-          if float(param_s2[key]) != float(param_s1[key]):
+          if norm_s2['fill'] is None or norm_s2['fill'] != norm_s1['fill']:
             logger.info(msgo)
             msg = f"{2*indent}val_{opts['s2']} = {param_s2[key]} != val_{opts['s1']} = {param_s1[key]}"
             if opts['mode'] == 'update':
-              logger.warning(msg)
+              logger.warning(msg, finding=finding)
             else:
-              logger.error(msg)
+              logger.error(msg, finding=finding)
       elif key == 'size' and isinstance(param_s2[key],list) and isinstance(param_s1[key], list):
         if param_s2[key] != param_s1[key]:
           logger.info(msgo)
-          logger.info(f"{2*indent}val_{opts['s2']} = {param_s2[key]} != val_{opts['s1']} = {param_s1[key]}")
+          logger.info(f"{2*indent}val_{opts['s2']} = {param_s2[key]} != val_{opts['s1']} = {param_s1[key]}", finding=finding)
       elif type(param_s2[key]) != type(param_s1[key]):
         logger.info(msgo)
         msg = f"{2*indent}type_{opts['s2']} = {type(param_s2[key])} != type_{opts['s1']} = {type(param_s1[key])}"
         if opts['mode'] == 'update':
-          logger.warning(msg)
+          logger.warning(msg, finding=finding)
         else:
-          logger.error(msg)
+          logger.error(msg, finding=finding)
       else:
         logger.info(msgo)
         if key == 'description':
@@ -299,23 +755,38 @@ def compare_parameter(dsid, param_s2, param_s1):
           msg2 = f"{2*indent}!="
           msg3 = f"{2*indent}val_{opts['s1']} = '{param_s1[key]}'"
           if opts['mode'] == 'update':
-            logger.warning(msg1)
+            logger.warning(msg1, finding=finding)
             logger.warning(msg2)
             logger.warning(msg3)
           else:
-            logger.error(msg1)
+            logger.error(msg1, finding=finding)
             logger.error(msg2)
             logger.error(msg3)
         else:
           msg = f"{2*indent}val_{opts['s2']} = '{param_s2[key]}' != val_{opts['s1']} = '{param_s1[key]}'"
           if opts['mode'] == 'update':
-            logger.warning(msg)
+            logger.warning(msg, finding=finding)
           else:
-            logger.error(msg)
+            logger.error(msg, finding=finding)
+
+def check_bins_references(info, server_name):
+  """Check that bins centers and ranges given as a string are parameter names."""
 
-  compare_bins(param_s2, param_s1)
+  for parameter in info["parameters"]:
+    for j, bins in enumerate(parameter.get("bins", [])):
+      for key in ['centers', 'ranges']:
+        ref = bins.get(key, None)
+        if isinstance(ref, str) and ref not in info["_parameters"]:
+          msg = f"  {server_name} {parameter['name']}/bins[{j}]/{key} = '{ref}' is not a parameter name"
+          finding = {"parameter": parameter['name'], "key": f"bins[{j}]/{key}", "s": server_name, "val": ref}
+          logger.error(msg, finding=finding)
 
 def compare_bins(params_s2, params_s1):
+  """Compare the bins of a parameter.
+
+  References to parameters by time-varying centers and ranges are checked
+  by check_bins_references().
+  """
 
   name_s2 = params_s2["name"]
   name_s1 = params_s1["name"]
@@ -323,22 +794,112 @@ def compare_bins(params_s2, params_s1):
     if 'bins' not in params_s1:
       logger.info(f"  {name_s2}")
       msg = f"{opts['s2']} has bins for '{name_s2}' but {opts['s1']} does not"
+      finding = {"parameter": name_s2, "key": "bins", "val_s1": False, "val_s2": True}
       if opts['mode'] == 'update':
-        logger.warning(msg)
+        logger.warning(msg, finding=finding)
       else:
-        logger.error(msg)
+        logger.error(msg, finding=finding)
   if 'bins' in params_s1:
     if 'bins' not in params_s2:
       logger.error(f"  {name_s1}")
-      logger.error(f"{opts['s1']} has bins for '{name_s1}' but {opts['s2']} does not")
+      finding = {"parameter": name_s1, "key": "bins", "val_s1": True, "val_s2": False}
+      logger.error(f"{opts['s1']} has bins for '{name_s1}' but {opts['s2']} does not", finding=finding)
   if 'bins' in params_s1:
     if 'bins' in params_s2:
-      n_bins_s2 = len(params_s1["bins"])
-      n_bins_s1 = len(params_s2["bins"])
+      n_bins_s2 = len(params_s2["bins"])
+      n_bins_s1 = len(params_s1["bins"])
       if n_bins_s2 != n_bins_s1:
-        logger.error(f"  {params_s1}/bins")
-        logger.error(f"{opts['s1']} has {n_bins_s1} bins objects; {opts['s2']} has {n_bins_s2}")
-      # TODO: Compare content at bins level
+        logger.error(f"  {name_s1}/bins")
+        finding = {"parameter": name_s1, "key": "bins", "val_s1": n_bins_s1, "val_s2": n_bins_s2}
+        logger.error(f"{opts['s1']} has {n_bins_s1} bins objects; {opts['s2']} has {n_bins_s2}", finding=finding)
+      for j in range(min(n_bins_s1, n_bins_s2)):
+        bins_s2 = params_s2["bins"][j]
+        bins_s1 = params_s1["bins"][j]
+        compare_bins_object(name_s1, j, bins_s2, bins_s1)
+
+def compare_bins_object(name, j, bins_s2, bins_s1):
+  """Compare bins object j of parameter name."""
+
+  indent = "  "
+  path = f"{name}/bins[{j}]"
+  if bins_s2 == bins_s1:
+    return
+
+  def report(key, msg, finding):
+    finding = {"parameter": name, "key": f"bins[{j}]/{key}", **finding}
+    logger.info(f"{indent}{path}/{key}")
+    if opts['mode'] == 'update':
+      logger.warning(msg, finding=finding)
+    else:
+      logger.error(msg, finding=finding)
+
+  keys_s1 = compared_keys(tuple(bins_s1.keys()))
+  keys_s2 = compared_keys(tuple(bins_s2.keys()))
+  if keys_s1 != keys_s2:
+    msg = f"{2*indent}keys_{opts['s2']} = {keys_s2} != keys_{opts['s1']} = {keys_s1}"
+    report('keys', msg, {"val_s1": keys_s1, "val_s2": keys_s2})
+
+  for key in sorted(set(keys_s1) & set(keys_s2)):
+    val_s1 = bins_s1[key]
+    val_s2 = bins_s2[key]
+    if key in ['centers', 'ranges'] and isinstance(val_s1, list) and isinstance(val_s2, list):
+      compare_bins_values(key, val_s2, val_s1, report)
+      continue
+    if val_s2 == val_s1:
+      continue
+    if key in ['centers', 'ranges'] and (isinstance(val_s1, list) or isinstance(val_s2, list)):
+      # Time-varying bins (parameter name) on one server; constant on other.
+      def describe(val):
+        return f"list of length {len(val)}" if isinstance(val, list) else repr(val)
+      msg = f"{2*indent}val_{opts['s2']} = {describe(val_s2)} != val_{opts['s1']} = {describe(val_s1)}"
+      report(key, msg, {"val_s1": describe(val_s1), "val_s2": describe(val_s2)})
+      continue
+    msg = f"{2*indent}val_{opts['s2']} = {val_s2!r} != val_{opts['s1']} = {val_s1!r}"
+    report(key, msg, {"val_s1": val_s1, "val_s2": val_s2})
+
+def compare_bins_values(key, val_s2, val_s1, report):
+  """Compare centers or ranges arrays using rtol and atol.
+
+  Reports, using report() from compare_bins_object(), the number of values
+  that differ and the maximum difference instead of the values.
+  """
+
+  import numpy
+
+  indent = "  "
+
+  try:
+    # null values become NaN.
+    a = numpy.array(val_s1, dtype=numpy.float64)
+    b = numpy.array(val_s2, dtype=numpy.float64)
+  except (TypeError, ValueError):
+    if val_s1 != val_s2:
+      report(key, f"{2*indent}values are not numeric arrays and differ", {"val_s1": None, "val_s2": None})
+    return
+
+  if a.shape != b.shape:
+    msg = f"{2*indent}shape_{opts['s2']} = {list(b.shape)} != shape_{opts['s1']} = {list(a.shape)}"
+    report(key, msg, {"val_s1": list(a.shape), "val_s2": list(b.shape)})
+    return
+
+  rtol = opts['rtol']
+  atol = opts['atol']
+  bad, diff = differences(a, b, rtol, atol)
+  n_bad = numpy.count_nonzero(bad)
+  if n_bad == 0:
+    return
+
+  index = numpy.unravel_index(numpy.argmax(numpy.where(bad, diff, -1)), bad.shape)
+  msg = f"{2*indent}{n_bad} of {bad.size} values differ by more than atol = {atol} + rtol = {rtol}*|val_{opts['s1']}|"
+  msg += f"; max |diff| = {diff[index]} at index {[int(i) for i in index]}"
+  finding = {
+    "n": int(n_bad),
+    "max_diff": diff[index].item(),
+    "index": [int(i) for i in index],
+    "val_s1": a[index].item(),
+    "val_s2": b[index].item()
+  }
+  report(key, msg, finding)
 
 def compare_data(dsid, datasets_s1, datasets_s2, opts, parameters=""):
 
@@ -349,75 +910,367 @@ def compare_data(dsid, datasets_s1, datasets_s2, opts, parameters=""):
   if dsid not in datasets_s2:
     return
 
+  current_dataset.set(dsid)
+
+  info_s1 = datasets_s1[dsid]['info']
+  info_s2 = datasets_s2[dsid]['info']
+
+  windows = sample_windows(info_s1, info_s2, opts)
+  chunks = []
+  for window in windows:
+    chunks.extend(split_window(window, opts))
+
+  logger.info(f"{dsid} - Checking data")
+  if len(windows) > 1 or len(chunks) > 1:
+    logger.info(f"  {len(windows)} window(s) split into {len(chunks)} chunk(s)")
+
+  if len(chunks) == 1 or opts['chunk_workers'] == 1:
+    for chunk in chunks:
+      compare_data_chunk(dsid, info_s1, parameters, chunk, opts)
+    return
+
+  def compare_data_chunk_buffered(chunk):
+    with logger.buffered() as records:
+      compare_data_chunk(dsid, info_s1, parameters, chunk, opts)
+    return records
+
+  # Chunks are fetched and compared concurrently; output for each chunk is
+  # written in time order as soon as it and all chunks before it are done.
+  with ThreadPoolExecutor(max_workers=opts['chunk_workers']) as pool:
+    futures = []
+    for chunk in chunks:
+      ctx = contextvars.copy_context()
+      futures.append(pool.submit(ctx.run, compare_data_chunk_buffered, chunk))
+    for future in futures:
+      logger.flush(future.result())
+
+def sample_windows(info_s1, info_s2, opts):
+  """Return list of [start, stop] time strings of windows of data to compare.
+
+  If sample_windows is 1, the window is sampleStartDate to sampleStopDate
+  from /info or, if not given, sample_duration starting at startDate. If
+  sample_windows = K > 1, K windows of length sample_duration are spread
+  evenly from the later startDate to the earlier stopDate.
+  """
+
+  def format(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+  duration = datetime.timedelta(**opts['sample_duration'])
+
+  def date(info, key):
+    # Parsed by normalize() if info is from the catalog.
+    if '_normalized' in info and info['_normalized']['dates'].get(key, None) is not None:
+      return info['_normalized']['dates'][key]
+    return hapitime2datetime(info[key])[0]
+
+  def start_date():
+    return max(date(info_s1, 'startDate'), date(info_s2, 'startDate'))
+
+  if opts['sample_windows'] > 1:
+    startDate = start_date()
+    stopDate = min(date(info_s1, 'stopDate'), date(info_s2, 'stopDate'))
+    span = stopDate - startDate - duration
+    if span > datetime.timedelta(0):
+      K = opts['sample_windows']
+      windows = []
+      for k in range(K):
+        start = startDate + k*span/(K - 1)
+        windows.append([format(start), format(start + duration)])
+      return windows
+
   sampleStartDate = None
   sampleStopDate = None
 
-  if 'sampleStartDate' in datasets_s2[dsid]['info']:
-    sampleStartDate = datasets_s2[dsid]['info']['sampleStartDate']
-  if 'sampleStartDate' in datasets_s1[dsid]['info']:
-    sampleStartDate = datasets_s1[dsid]['info']['sampleStartDate']
+  if 'sampleStartDate' in info_s2:
+    sampleStartDate = info_s2['sampleStartDate']
+  if 'sampleStartDate' in info_s1:
+    sampleStartDate = info_s1['sampleStartDate']
 
-  if 'sampleStopDate' in datasets_s2[dsid]['info']:
-    sampleStopDate = datasets_s2[dsid]['info']['sampleStopDate']
-  if 'sampleStartDate' in datasets_s1[dsid]['info']:
-    sampleStopDate = datasets_s1[dsid]['info']['sampleStopDate']
+  if 'sampleStopDate' in info_s2:
+    sampleStopDate = info_s2['sampleStopDate']
+  if 'sampleStartDate' in info_s1:
+    sampleStopDate = info_s1['sampleStopDate']
 
   if sampleStartDate is None or sampleStopDate is None:
-    startDate_s1 = hapitime2datetime(datasets_s1[dsid]['info']['startDate'])[0]
-    startDate_s2 = hapitime2datetime(datasets_s2[dsid]['info']['startDate'])[0]
-    if startDate_s1 != startDate_s2:
-      sampleStartDate = max(startDate_s1, startDate_s2)
-    else:
-      sampleStartDate = startDate_s1
+    startDate = start_date()
+    sampleStartDate = format(startDate)
+    sampleStopDate = format(startDate + duration)
+
+  return [[sampleStartDate, sampleStopDate]]
+
+def split_window(window, opts):
+  """Split window into chunks of length chunk_duration, if given."""
+
+  if opts['chunk_duration'] is None:
+    return [window]
+
+  start = hapitime2datetime(window[0])[0]
+  stop = hapitime2datetime(window[1])[0]
+  chunk_duration = datetime.timedelta(**opts['chunk_duration'])
 
-    sampleStopDate = sampleStartDate + datetime.timedelta(**opts['sample_duration'])
+  chunks = []
+  while start < stop:
+    chunk_stop = min(start + chunk_duration, stop)
+    chunks.append([start.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), chunk_stop.strftime('%Y-%m-%dT%H:%M:%S.%fZ')])
+    start = chunk_stop
 
-    sampleStartDate = sampleStartDate.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    sampleStopDate = sampleStopDate.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+  return chunks
+
+def compare_data_chunk(dsid, info, parameters, chunk, opts):
+  """Request and compare data in time range chunk = [start, stop]."""
 
   times = 2*[None]
   resps = 2*[None]
+  errors = 2*[None]
 
   urlo = "/data?id=" + dsid \
         + "&parameters=" + ",".join(parameters) \
-        + "&time.min=" + sampleStartDate \
-        + "&time.max=" + sampleStopDate
+        + "&time.min=" + chunk[0] \
+        + "&time.max=" + chunk[1]
+  if opts['data_format'] == 'binary':
+    urlo += "&format=binary"
 
   urls = [opts['url1'] + urlo, opts['url2'] + urlo]
 
   def get(i):
     start = time.time()
+    expire_after = opts.get(f's{i + 1}_data_expire_after', None)
+    cached = data_cache is not None and expire_after is not None
+    if cached:
+      resps[i] = data_cache.get(urls[i], expire_after)
+      if resps[i] is not None:
+        logger.info("  Got: (from cache) " + urls[i])
+        times[i] = time.time() - start
+        return
     logger.info("  Getting: " + urls[i])
-    resps[i] = requests.get(urls[i], verify=False)
+    # If stream is True, only the headers have been read when get() returns.
+    # Responses to be cached are read in full.
+    try:
+      session = data_session(opts[f'url{i + 1}'])
+      with span('data_fetch', server=opts[f's{i + 1}']):
+        resps[i] = scheduler.request('get', urls[i], session=session, stream=opts['stream'] and not cached)
+    except requests.RequestException as e:
+      errors[i] = e
+    if cached and resps[i] is not None and resps[i].status_code == 200:
+      data_cache.put(urls[i], resps[i])
     times[i] = time.time() - start
 
-  logger.info(f"{dsid} - Checking data")
+  # Responses are closed even if a comparison is not made so that the
+  # connection of an unread streamed response is not kept out of the pool.
+  try:
+    if opts['parallel'] is False:
+      get(0)
+      get(1)
+    else:
+      with ThreadPoolExecutor(max_workers=2) as pool:
+        # Run in a copy of this thread's context so output from get() goes to
+        # the buffer of this dataset when datasets are compared in parallel.
+        futures = [pool.submit(contextvars.copy_context().run, get, i) for i in range(2)]
+        for future in futures:
+          future.result()
+
+    # Status is the name of the exception if a request failed after all retries.
+    status = 2*[None]
+    for i in range(2):
+      status[i] = type(errors[i]).__name__ if resps[i] is None else resps[i].status_code
+
+    dt1 = "{0:.6f}".format(times[0])
+    msg1 = f"  {opts['s1_padded']} time = {dt1} [s]; status = {status[0]}"
+    if status[0] != 200:
+      logger.error(msg1)
+    else:
+      logger.info(msg1)
 
-  if opts['parallel'] is False:
-    get(0)
-    get(1)
-  else:
-    from concurrent.futures import ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=2) as pool:
-      pool.map(get, range(2))
-
-  dt1 = "{0:.6f}".format(times[0])
-  msg1 = f"  {opts['s1_padded']} time = {dt1} [s]; status = {resps[0].status_code}"
-  if resps[0].status_code != 200:
-    logger.error(msg1)
-  else:
-    logger.info(msg1)
+    dt2 = "{0:.6f}".format(times[1])
+    msg2 = f"  {opts['s2_padded']} time = {dt2} [s]; status = {status[1]}"
+    if status[1] != 200:
+      logger.error(msg2)
+    else:
+      logger.info(msg2)
+
+    if status[0] != status[1]:
+      finding = {"key": "status", "val_s1": status[0], "val_s2": status[1], "time": chunk}
+      logger.error(f"  {opts['s2']} HTTP status = {status[1]} != {opts['s1']} HTTP status = {status[0]}", finding=finding)
+      return
+    if resps[0] is None:
+      return
+
+    if parameters == "":
+      parameters = list(info['_parameters'].keys())
+
+    # If stream is True, data_compare includes the time to read the responses.
+    # A failed read of a body is reported like a failed request.
+    n_bytes = 2*[None]
+    with span('data_compare'):
+      if opts['stream'] and (opts['data_format'] == 'binary' or opts['data_mode'] == 'tolerance'):
+        # These comparisons use the whole body.
+        for i in range(2):
+          try:
+            resps[i].content
+          except requests.RequestException as e:
+            errors[i] = e
+      if any(errors):
+        pass
+      elif opts['data_format'] == 'binary':
+        compare_data_binary(resps, info, parameters, opts)
+      elif opts['data_mode'] == 'tolerance':
+        compare_data_tolerance(resps, info, parameters, opts)
+      elif opts['stream']:
+        stats = compare_data_stream(resps, opts)
+        n_bytes = [stats[0]['bytes'], stats[1]['bytes']]
+        errors = [stats[0]['error'], stats[1]['error']]
+      else:
+        compare_data_text(resps, opts)
+
+    if any(errors):
+      for i in range(2):
+        status[i] = 200 if errors[i] is None else type(errors[i]).__name__
+      finding = {"key": "status", "val_s1": status[0], "val_s2": status[1], "time": chunk}
+      logger.error(f"  Reading data failed: {opts['s2']} status = {status[1]}; {opts['s1']} status = {status[0]}", finding=finding)
+      return
+
+    for i, s in enumerate(['s1', 's2']):
+      if n_bytes[i] is None:
+        n_bytes[i] = len(resps[i].content)
+      add_transfer(opts[s], resps[i], n_bytes[i])
+  finally:
+    for resp in resps:
+      if resp is not None:
+        resp.close()
+
+  if opts['benchmark'] > 0:
+    benchmark_chunk(dsid, urls, opts)
+
+def benchmark_chunk(dsid, urls, opts):
+  """Request urls[0] and urls[1] opts['benchmark'] times each and record timing.
+
+  For each request, time to first byte (time until the response headers are
+  read), total time, and number of bytes (decoded and on the wire) are
+  appended to benchmark_results.
+  """
+
+  for s, url in zip(['s1', 's2'], urls):
+    results = []
+    session = data_session(opts[f'url{s[1]}'])
+    host = scheduler.host(url)
+    for _ in range(opts['benchmark']):
+      # The request is made directly instead of with scheduler.request() so
+      # that times start after a slot is acquired and do not include waiting
+      # for requests of other datasets and chunks. There are no retries so
+      # that times are those of single requests.
+      scheduler.acquire(host)
+      start = time.time()
+      try:
+        resp = session.get(url, stream=True, timeout=scheduler.timeout)
+        status = resp.status_code
+      except requests.RequestException as e:
+        resp = None
+        status = type(e).__name__
+      finally:
+        # Slot released when headers are read, as in scheduler.request().
+        # Latency of None so these requests do not change the limit.
+        scheduler.release(host, resp is not None, None, urlparse(url).netloc)
+      ttfb = time.time() - start
+      n_bytes = 0
+      n_bytes_wire = 0
+      if resp is not None:
+        try:
+          for chunk in resp.iter_content(chunk_size=65536):
+            n_bytes += len(chunk)
+        except requests.RequestException as e:
+          status = type(e).__name__
+          finding = {"key": "benchmark", "s": opts[s], "url": url, "val": status}
+          logger.error(f"  {opts[f'{s}_padded']} benchmark: reading {url} failed: {status}", finding=finding)
+        finally:
+          n_bytes_wire = resp.raw.tell()
+          resp.close()
+      total = time.time() - start
+      results.append({
+        "dataset": dsid,
+        "server": opts[s],
+        "url": url,
+        "status": status,
+        "ttfb": ttfb,
+        "total": total,
+        "bytes": n_bytes,
+        "wire_bytes": n_bytes_wire,
+        "MBps": n_bytes/total/1e6 if total > 0 else float('nan')
+      })
+    benchmark_results.extend(results)
+
+    stats = benchmark_stats(results)
+    msg = f"  {opts[f'{s}_padded']} benchmark: {len(results)} requests; p50 ttfb = {stats['ttfb']['p50']:.6f} [s]; "
+    msg += f"p50 total = {stats['total']['p50']:.6f} [s]; p50 MB/s = {stats['MBps']['p50']:.3f}"
+    logger.info(msg)
+
+def benchmark_stats(results):
+  """p50, p90, and p99 of ttfb, total, and MB/s of benchmark results."""
+
+  import numpy
+
+  stats = {}
+  for key in ['ttfb', 'total', 'MBps']:
+    values = numpy.array([result[key] for result in results], dtype=numpy.float64)
+    p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+    stats[key] = {"p50": p50, "p90": p90, "p99": p99}
+  stats['requests'] = len(results)
+  stats['bytes'] = sum(result['bytes'] for result in results)
+  return stats
+
+def write_benchmark(opts):
+  """Write benchmark results and statistics per dataset and server.
+
+  Files are {data_dir}/benchmark.{conf}.json, with all results and statistics,
+  and {data_dir}/benchmark.{conf}.csv, with one row of statistics per dataset
+  and server. Rows with dataset = '*' are for all datasets.
+  """
+
+  import csv
+
+  if len(benchmark_results) == 0:
+    logger.info("No benchmark results to write")
+    return
 
-  dt2 = "{0:.6f}".format(times[1])
-  msg2 = f"  {opts['s2_padded']} time = {dt2} [s]; status = {resps[1].status_code}"
-  if resps[1].status_code != 200:
-    logger.error(msg2)
-  else:
-    logger.info(msg2)
+  groups = {}
+  for result in benchmark_results:
+    groups.setdefault((result['dataset'], result['server']), []).append(result)
+    groups.setdefault(('*', result['server']), []).append(result)
 
-  if resps[0].status_code != resps[1].status_code:
-    logger.error(f"  {opts['s2']} HTTP status = {resps[1].status_code} != {opts['s1']} HTTP status = {resps[0].status_code}")
-    return
+  summary = {"datasets": {}, "servers": {}}
+  for (dsid, server), results in groups.items():
+    if dsid == '*':
+      summary['servers'][server] = benchmark_stats(results)
+    else:
+      summary['datasets'].setdefault(dsid, {})[server] = benchmark_stats(results)
+
+  fname = f"{opts['data_dir']}/benchmark.{opts['name']}"
+  with open(fname + '.json', 'w', encoding='utf-8') as f:
+    json.dump({"summary": summary, "results": benchmark_results}, f, indent=2)
+  logger.info(f"Wrote {fname}.json")
+
+  with open(fname + '.csv', 'w', encoding='utf-8', newline='') as f:
+    writer = csv.writer(f)
+    header = ['dataset', 'server', 'requests', 'bytes']
+    for key in ['ttfb', 'total', 'MBps']:
+      header.extend([f'{key}_p50', f'{key}_p90', f'{key}_p99'])
+    writer.writerow(header)
+    # Rows for all datasets last; sorted() is stable so catalog order is kept.
+    for (dsid, server), results in sorted(groups.items(), key=lambda item: item[0][0] == '*'):
+      stats = benchmark_stats(results)
+      row = [dsid, server, stats['requests'], stats['bytes']]
+      for key in ['ttfb', 'total', 'MBps']:
+        row.extend([stats[key]['p50'], stats[key]['p90'], stats[key]['p99']])
+      writer.writerow(row)
+  logger.info(f"Wrote {fname}.csv")
+
+  for server, stats in summary['servers'].items():
+    msg = f"{server} benchmark: {stats['requests']} requests; "
+    msg += f"ttfb p50/p90/p99 = {stats['ttfb']['p50']:.6f}/{stats['ttfb']['p90']:.6f}/{stats['ttfb']['p99']:.6f} [s]; "
+    msg += f"MB/s p50 = {stats['MBps']['p50']:.3f}"
+    logger.info(msg)
+
+def compare_data_text(resps, opts):
 
   after =  "after replacement of '\\r\\n' with '\\n' and trimming trailing whitespace."
 
@@ -447,100 +1300,1207 @@ def compare_data(dsid, datasets_s1, datasets_s2, opts, parameters=""):
     if len(body1s) == len(body2s):
       logger.info(f"  {opts['s2']} data has {len(body2s)} lines; {opts['s1']} data has {len(body1s)} lines {after}")
     else:
-      logger.error(f"  {opts['s2']} data has {len(body2s)} lines; {opts['s1']} data has {len(body1s)} lines {after}")
+      finding = {"key": "lines", "val_s1": len(body1s), "val_s2": len(body2s)}
+      logger.error(f"  {opts['s2']} data has {len(body2s)} lines; {opts['s1']} data has {len(body1s)} lines {after}", finding=finding)
+
+    diff_records(iter(body1s), iter(body2s), opts)
+
+def iter_lines(resp, stats, chunk_size=65536):
+  """Yield lines of a streamed response body.
+
+  Lines are yielded as they arrive with '\\r\\n' replaced by '\\n'. Trailing
+  whitespace at the end of the body is removed, so the lines are the same as
+  those from resp.text.replace("\\r\\n", "\\n").rstrip().splitlines() when
+  the body only uses '\\n' or '\\r\\n' line endings. stats['bytes'] and
+  stats['lines'] are updated as the body is read. If reading the body fails,
+  stats['error'] is set to the exception before it is raised.
+  """
+  pending = b''
+  last = None   # Last non-blank line; held back in case it ends the body.
+  blank = []    # Whitespace-only lines after last; dropped if they end the body.
+
+  def split(pending):
+    lines = pending.split(b'\n')
+    return lines[:-1], lines[-1]
+
+  def decode(line):
+    if line.endswith(b'\r'):
+      line = line[:-1]
+    return line.decode('utf-8', errors='replace')
+
+  try:
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+      stats['bytes'] += len(chunk)
+      lines, pending = split(pending + chunk)
+      for line in lines:
+        line = decode(line)
+        if line.strip() == '':
+          blank.append(line)
+          continue
+        if last is not None:
+          stats['lines'] += 1
+          yield last
+        for line_blank in blank:
+          stats['lines'] += 1
+          yield line_blank
+        last = line
+        blank = []
+  except requests.RequestException as e:
+    stats['error'] = e
+    raise
+
+  pending = decode(pending)
+  if pending.strip() != '':
+    if last is not None:
+      stats['lines'] += 1
+      yield last
+    for line_blank in blank:
+      stats['lines'] += 1
+      yield line_blank
+    last = pending
+
+  if last is not None:
+    stats['lines'] += 1
+    yield last.rstrip()
+
+def compare_data_stream(resps, opts):
+  """Compare data records while reading both responses incrementally.
+
+  Memory use is bounded by the read buffer and the longest line instead of
+  the size of the response. Returns the number of bytes and lines read from
+  each response and, if reading a response failed, the exception. Nothing
+  more is compared after a failed read.
+  """
 
-    n = 0
-    for i in range(min(len(body1s), len(body2s))):
-      if body1s[i] != body2s[i]:
-        msg = f"  Line {i}:"
-        logger.error(msg)
-        logger.error(f"    {opts['s1_padded']}: {body1s[i]}")
-        logger.error(f"    {opts['s2_padded']}: {body2s[i]}")
-        n += 1
-        if n > 10:
-          logger.error("  More than 10 lines differ; not displaying more.")
+  after =  "after replacement of '\\r\\n' with '\\n' and trimming trailing whitespace."
+
+  stats = [{'bytes': 0, 'lines': 0, 'error': None}, {'bytes': 0, 'lines': 0, 'error': None}]
+  lines1 = iter_lines(resps[0], stats[0])
+  lines2 = iter_lines(resps[1], stats[1])
+
+  try:
+    counts = diff_records(lines1, lines2, opts)
+  except requests.RequestException:
+    return stats
+
+  n_lines1 = stats[0]['lines']
+  n_lines2 = stats[1]['lines']
+  if stats[0]['bytes'] != stats[1]['bytes']:
+    logger.info(f"  {opts['s2']} data has {stats[1]['bytes']} bytes; {opts['s1']} data has {stats[0]['bytes']} bytes")
+  if n_lines1 == n_lines2:
+    if counts['differ'] > 0:
+      logger.info(f"  {opts['s2']} data has {n_lines2} lines; {opts['s1']} data has {n_lines1} lines {after}")
+  else:
+    finding = {"key": "lines", "val_s1": n_lines1, "val_s2": n_lines2}
+    logger.error(f"  {opts['s2']} data has {n_lines2} lines; {opts['s1']} data has {n_lines1} lines {after}", finding=finding)
+
+  return stats
+
+@functools.lru_cache(maxsize=1024)
+def record_date(date):
+  """Return HAPI date YYYY, YYYY-MM, YYYY-MM-DD, or YYYY-DDD as YYYY-MM-DD."""
+  parts = date.split('-')
+  if len(parts) == 2 and len(parts[1]) == 3:
+    day = datetime.datetime(int(parts[0]), 1, 1) + datetime.timedelta(days=int(parts[1]) - 1)
+    return day.strftime('%Y-%m-%d')
+  return '-'.join(parts + (3 - len(parts))*['01'])
+
+def record_time(line):
+  """Return the leading timestamp of a CSV record in a form that sorts by time.
+
+  HAPI allows truncated times and year-day dates, so servers may write the
+  same time differently. Times are returned as YYYY-MM-DDThh:mm:ss.fffffffff,
+  e.g., 2000-001T00:00Z and 2000-01-01T00:00:00.000Z are both
+  2000-01-01T00:00:00.000000000. A timestamp that cannot be converted is
+  returned as is.
+  """
+  t = line.split(',', 1)[0].strip().strip('"')
+  date, _, clock = t.rstrip('Z').partition('T')
+  hms, _, fraction = clock.partition('.')
+  hms = hms.split(':') if hms != '' else []
+  if not date[0:4].isdigit():
+    return t
+  try:
+    date = record_date(date)
+  except ValueError:
+    return t
+  return f"{date}T{':'.join(hms + (3 - len(hms))*['00'])}.{fraction.ljust(9, '0')}"
+
+def diff_records(lines1, lines2, opts, n_show=10):
+  """Merge-join the records of two CSV responses on their leading timestamp.
+
+  lines1 and lines2 are iterators of lines in time order. A record in only
+  s1 is "missing" (from s2), a record in only s2 is "extra", and records
+  with the same time but different lines "differ". Records are read once and
+  only the current record of each is held, so time is O(n) and memory use is
+  bounded. The first n_show records of each kind are shown and the number of
+  each is returned as a dict.
+  """
+
+  counts = {"missing": 0, "extra": 0, "differ": 0}
+  labels = {
+    "missing": f"in {opts['s1']} but not in {opts['s2']}",
+    "extra": f"in {opts['s2']} but not in {opts['s1']}",
+    "differ": "differs"
+  }
+  unordered = set()
+  last = [None, None]
+
+  def report(kind, t, line1, line2):
+    counts[kind] += 1
+    if counts[kind] > n_show:
+      return
+    finding = {"key": "record", "kind": kind, "time": t, "val_s1": line1, "val_s2": line2}
+    logger.error(f"  Record at {t} {labels[kind]}", finding=finding)
+    if line1 is not None:
+      logger.error(f"    {opts['s1_padded']}: {line1}")
+    if line2 is not None:
+      logger.error(f"    {opts['s2_padded']}: {line2}")
+    if counts[kind] == n_show:
+      logger.error(f"  Not displaying more records that are {labels[kind]}.")
+
+  def advance(lines, i):
+    line = next(lines, None)
+    if line is None:
+      return None, None
+    t = record_time(line)
+    if last[i] is not None and t < last[i] and i not in unordered:
+      # Merge-join assumes time order; results after this are not reliable.
+      unordered.add(i)
+      s = opts['s1'] if i == 0 else opts['s2']
+      finding = {"key": "order", "s": s, "time": t, "previous": last[i]}
+      logger.error(f"  {s} record at {t} is before previous record at {last[i]}", finding=finding)
+    last[i] = t
+    return line, t
+
+  line1, t1 = advance(lines1, 0)
+  line2, t2 = advance(lines2, 1)
+  while line1 is not None or line2 is not None:
+    if line2 is None or (line1 is not None and t1 < t2):
+      report("missing", t1, line1, None)
+      line1, t1 = advance(lines1, 0)
+    elif line1 is None or t2 < t1:
+      report("extra", t2, None, line2)
+      line2, t2 = advance(lines2, 1)
+    else:
+      if line1 != line2:
+        report("differ", t1, line1, line2)
+      line1, t1 = advance(lines1, 0)
+      line2, t2 = advance(lines2, 1)
+
+  if any(counts.values()):
+    msg = f"  Records {labels['missing']} = {counts['missing']}; "
+    msg += f"{labels['extra']} = {counts['extra']}; "
+    msg += f"that differ = {counts['differ']}"
+    logger.error(msg, finding={"key": "records", **counts})
+
+  return counts
+
+def read_csv(text, info, parameters):
+  """Parse a HAPI CSV response into a dict of columnar arrays.
+
+  Keys are parameter names. isotime and string parameters are returned as
+  arrays of str; int and double parameters as float64 arrays. Arrays have
+  shape (n_records, n_columns), where n_columns is the product of the
+  parameter's size.
+  """
+
+  import numpy
+  import io
+
+  if parameters[0] != info['parameters'][0]['name']:
+    # Time parameter is always returned, even if not requested.
+    parameters = [info['parameters'][0]['name'], *parameters]
+
+  n_columns = []
+  for name in parameters:
+    size = info['_parameters'][name].get('size', [1])
+    n_columns.append(int(numpy.prod(size)))
+
+  if text.strip() == '':
+    table = numpy.empty((0, sum(n_columns)), dtype=str)
+  else:
+    # newline=None translates '\r\n' to '\n' as the text is read.
+    table = numpy.loadtxt(io.StringIO(text, newline=None), delimiter=',',
+                          dtype=str, quotechar='"', ndmin=2, comments=None)
+
+  if table.shape[1] != sum(n_columns):
+    msg = f"Number of columns = {table.shape[1]} but /info parameters imply {sum(n_columns)}"
+    raise ValueError(msg)
+
+  data = {}
+  start = 0
+  for name, n in zip(parameters, n_columns):
+    columns = table[:, start:start + n]
+    if info['_parameters'][name]['type'] in ['int', 'double']:
+      columns = columns.astype(numpy.float64)
+    data[name] = columns
+    start += n
+
+  return data
+
+def compare_data_tolerance(resps, info, parameters, opts):
+  """Compare numeric values using a tolerance and other values exactly.
+
+  A value differs if |val_s2 - val_s1| > atol + rtol*|val_s1|. NaNs in the
+  same position in both are considered equal.
+  """
+
+  try:
+    data1 = read_csv(resps[0].text, info, parameters)
+  except ValueError as e:
+    logger.error(f"  {opts['s1']} data could not be parsed: {e}")
+    return
+  try:
+    data2 = read_csv(resps[1].text, info, parameters)
+  except ValueError as e:
+    logger.error(f"  {opts['s2']} data could not be parsed: {e}")
+    return
+
+  compare_columns(data1, data2, opts['rtol'], opts['atol'], opts)
+
+def read_binary(content, info, parameters):
+  """Decode a HAPI binary response into a dict of columnar arrays.
+
+  Same as read_csv() except that isotime and string values are bytes.
+  """
+
+  import numpy
+
+  if parameters[0] != info['parameters'][0]['name']:
+    # Time parameter is always returned, even if not requested.
+    parameters = [info['parameters'][0]['name'], *parameters]
+
+  # HAPI binary is little-endian with int as 4-byte integers, double as
+  # 8-byte floats, and isotime and string as null-padded byte strings.
+  dtype = []
+  for name in parameters:
+    parameter = info['_parameters'][name]
+    if parameter['type'] in ['isotime', 'string']:
+      base = f"S{parameter['length']}"
+    elif parameter['type'] == 'int':
+      base = '<i4'
+    else:
+      base = '<f8'
+    dtype.append((name, base, tuple(parameter.get('size', [1]))))
+  dtype = numpy.dtype(dtype)
+
+  if len(content) % dtype.itemsize != 0:
+    msg = f"Number of bytes = {len(content)} is not a multiple of record size = {dtype.itemsize} implied by /info parameters"
+    raise ValueError(msg)
+
+  records = numpy.frombuffer(content, dtype=dtype)
+
+  data = {}
+  for name in parameters:
+    columns = records[name].reshape(records.shape[0], -1)
+    if columns.dtype.kind in ['i', 'f']:
+      columns = columns.astype(numpy.float64)
+    data[name] = columns
+
+  return data
+
+def compare_data_binary(resps, info, parameters, opts):
+  """Compare HAPI binary responses.
+
+  Numeric values are compared using rtol and atol if data_mode is
+  'tolerance' and exactly otherwise.
+  """
+
+  try:
+    data1 = read_binary(resps[0].content, info, parameters)
+  except (ValueError, KeyError) as e:
+    logger.error(f"  {opts['s1']} data could not be decoded: {e}")
+    return
+  try:
+    data2 = read_binary(resps[1].content, info, parameters)
+  except (ValueError, KeyError) as e:
+    logger.error(f"  {opts['s2']} data could not be decoded: {e}")
+    return
+
+  if opts['data_mode'] == 'tolerance':
+    compare_columns(data1, data2, opts['rtol'], opts['atol'], opts)
+  else:
+    compare_columns(data1, data2, 0.0, 0.0, opts)
+
+def differences(a, b, rtol, atol):
+  """Return (bad, diff) for float arrays a and b of the same shape.
+
+  bad is True where |b - a| > atol + rtol*|a| or where only one of a and b is
+  NaN. diff is |b - a|, 0 where both are NaN, and inf where only one is.
+  """
+
+  import numpy
+
+  nan_a = numpy.isnan(a)
+  nan_b = numpy.isnan(b)
+  with numpy.errstate(invalid='ignore'):
+    diff = numpy.abs(b - a)
+    bad = (diff > atol + rtol*numpy.abs(a)) | (nan_a != nan_b)
+  diff[nan_a & nan_b] = 0
+  diff[nan_a != nan_b] = numpy.inf
+  return bad, diff
+
+def compare_columns(data1, data2, rtol, atol, opts):
+  """Compare dicts of columnar arrays from read_csv() or read_binary()."""
+
+  import numpy
+
+  names = list(data1.keys())
+  n_records1 = data1[names[0]].shape[0]
+  n_records2 = data2[names[0]].shape[0]
+  if n_records1 != n_records2:
+    finding = {"key": "records", "val_s1": n_records1, "val_s2": n_records2}
+    logger.error(f"  {opts['s2']} data has {n_records2} records; {opts['s1']} data has {n_records1} records", finding=finding)
+    logger.error(f"  Comparing first {min(n_records1, n_records2)} records")
+  n = min(n_records1, n_records2)
+
+  worst = None
+  for name in names:
+    a = data1[name][0:n]
+    b = data2[name][0:n]
+    if a.dtype.kind == 'f':
+      bad, diff = differences(a, b, rtol, atol)
+    else:
+      bad = a != b
+      diff = None
+
+    n_bad = numpy.count_nonzero(bad)
+    if n_bad == 0:
+      continue
+
+    if diff is None:
+      row, column = numpy.unravel_index(numpy.argmax(bad), bad.shape)
+    else:
+      row, column = numpy.unravel_index(numpy.argmax(numpy.where(bad, diff, -1)), bad.shape)
+    msg = f"  {name}: {n_bad} of {bad.size} values differ"
+    if diff is None:
+      msg += f"; first at record {row}, column {column}"
+    else:
+      msg += f" by more than atol = {atol} + rtol = {rtol}*|val_{opts['s1']}|"
+      msg += f"; max |diff| = {diff[row, column]} at record {row}, column {column}"
+      if worst is None or diff[row, column] > worst[1]:
+        worst = (name, diff[row, column], row, column)
+    finding = {
+      "parameter": name,
+      "key": "values",
+      "n": int(n_bad),
+      "record": int(row),
+      "column": int(column),
+      "val_s1": a[row, column].item(),
+      "val_s2": b[row, column].item()
+    }
+    logger.error(msg, finding=finding)
+    logger.error(f"    {opts['s1_padded']}: {a[row, column]}")
+    logger.error(f"    {opts['s2_padded']}: {b[row, column]}")
+
+  if worst is not None:
+    msg = f"  Worst numeric difference: {worst[0]} |diff| = {worst[1]} at record {worst[2]}, column {worst[3]}"
+    logger.error(msg)
+
+def load_mix(datasets_s1, datasets_s2, opts):
+  """Paths of /info and /data requests for datasets on both servers.
+
+  The /data request is for the first window from sample_windows().
+  """
+  paths = []
+  for dsid in datasets_s1.keys():
+    if dsid not in datasets_s2:
+      continue
+    paths.append("/info?id=" + dsid)
+    window = sample_windows(datasets_s1[dsid]['info'], datasets_s2[dsid]['info'], opts)[0]
+    path = "/data?id=" + dsid + "&time.min=" + window[0] + "&time.max=" + window[1]
+    if opts['data_format'] == 'binary':
+      path += "&format=binary"
+    paths.append(path)
+  return paths
+
+def load_run(server_url, paths, concurrency, opts):
+  """Make requests for paths using concurrency clients.
+
+  Each client has its own session and makes requests for paths in turn until
+  load_requests requests have been made by all clients or, if load_requests
+  is None, load_duration seconds have elapsed.
+  """
+
+  import numpy
+
+  results = []
+  counter = itertools.count()
+  start = time.time()
+
+  def client(k):
+    session = requests.Session()
+    while True:
+      n = next(counter)
+      if opts['load_requests'] is not None:
+        if n >= opts['load_requests']:
           break
+      elif time.time() - start > opts['load_duration']:
+        break
+      url = server_url + paths[n % len(paths)]
+      t = time.time()
+      try:
+        resp = session.get(url, verify=False, timeout=opts['timeout'])
+        results.append({"latency": time.time() - t, "status": resp.status_code, "bytes": len(resp.content)})
+      except requests.RequestException:
+        results.append({"latency": time.time() - t, "status": None, "bytes": 0})
+    session.close()
+
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    list(pool.map(client, range(concurrency)))
+  elapsed = time.time() - start
+
+  latency = numpy.array([result['latency'] for result in results], dtype=numpy.float64)
+  p50, p90, p99 = numpy.percentile(latency, [50, 90, 99]) if len(results) > 0 else 3*[float('nan')]
+  n_errors = sum(1 for result in results if result['status'] != 200)
+  n_bytes = sum(result['bytes'] for result in results)
+  return {
+    "concurrency": concurrency,
+    "requests": len(results),
+    "errors": n_errors,
+    "error_rate": n_errors/len(results) if len(results) > 0 else float('nan'),
+    "elapsed": elapsed,
+    "throughput": len(results)/elapsed,
+    "MBps": n_bytes/elapsed/1e6,
+    "latency": {"p50": p50, "p90": p90, "p99": p99}
+  }
+
+def load_test(datasets_s1, datasets_s2, opts):
+  """Measure throughput, error rate, and latency of both servers as the number
+  of concurrent clients increases. Results are written to
+  {data_dir}/load.{conf}.json.
+  """
+
+  paths = load_mix(datasets_s1, datasets_s2, opts)
+  if len(paths) == 0:
+    logger.error("No datasets on both servers; no requests for load test")
+    return
+
+  stop = f"{opts['load_requests']} requests" if opts['load_requests'] is not None else f"{opts['load_duration']} [s]"
+  logger.info(f"Load test with {len(paths)} /info and /data requests; {stop} per concurrency level")
+
+  urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+  summary = {opts['s1']: [], opts['s2']: []}
+  for concurrency in opts['load']:
+    for s in ['s1', 's2']:
+      server_url = opts[f'url{s[1]}']
+      if not server_url.startswith('http'):
+        continue
+      stats = load_run(server_url, paths, concurrency, opts)
+      summary[opts[s]].append(stats)
+      msg = f"  clients = {concurrency}; {opts[f'{s}_padded']}: {stats['throughput']:.2f} [requests/s]; "
+      msg += f"{stats['MBps']:.3f} [MB/s]; errors = {stats['errors']}/{stats['requests']}; "
+      msg += f"latency p50/p90/p99 = {stats['latency']['p50']:.6f}/{stats['latency']['p90']:.6f}/{stats['latency']['p99']:.6f} [s]"
+      if stats['errors'] > 0:
+        logger.error(msg)
+      else:
+        logger.info(msg)
+
+  fname = f"{opts['data_dir']}/load.{opts['name']}.json"
+  with open(fname, 'w', encoding='utf-8') as f:
+    json.dump(summary, f, indent=2)
+  logger.info(f"Wrote {fname}")
+
+  return summary
 
 def remove_keys(keys, s, opts):
-  for key in keys.copy():
-    if f'{s}_omits' in opts and key in opts[f'{s}_omits']:
-      keys.remove(key)
-    if key.startswith("x_"):
-      keys.remove(key)
-    if key in ['_parameters', 'parameters']:
-      keys.remove(key)
-  return keys
+  # Keys that start with "_" are added by restructure(), normalize(), etc.
+  omits = set(opts.get(f'{s}_omits', None) or [])
+  return [key for key in keys if key not in omits and key != 'parameters' and key[0:2] != 'x_' and key[0:1] != '_']
+
+class HostScheduler:
+  """Limit, retry, and time out HTTP requests, per host.
+
+  The number of requests in progress to a host is limited to a value that
+  adapts to how the host responds: it increases by one after about limit
+  healthy responses and is halved after an error or a response that took more
+  than latency_factor times the moving average response time and more than
+  latency_min seconds. Requests that
+  fail with a connection error, a timeout, or a status in retry_codes are
+  retried up to retries times with jittered exponential backoff.
+
+  For requests with stream=True, the slot is released when the headers have
+  been read.
+  """
+
+  retry_codes = [429, 502, 503, 504]
+  retry_exceptions = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+  latency_factor = 4
+  latency_min = 1.0   # Responses faster than this [s] are never considered slow
+
+  def __init__(self, max_per_host=8, timeout=60, retries=3, backoff=1.0):
+    self.max_per_host = max_per_host
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.hosts = {}
+    self.lock = threading.Lock()
+
+  def host(self, url):
+    netloc = urlparse(url).netloc
+    with self.lock:
+      if netloc not in self.hosts:
+        self.hosts[netloc] = {
+          "condition": threading.Condition(),
+          "limit": min(2, self.max_per_host),
+          "active": 0,
+          "latency": None,   # Moving average response time
+          "n": 0             # Number of responses used for latency
+        }
+      return self.hosts[netloc]
+
+  def acquire(self, host):
+    with host['condition']:
+      while host['active'] >= int(host['limit']):
+        host['condition'].wait()
+      host['active'] += 1
+
+  def release(self, host, healthy, latency, netloc):
+    with host['condition']:
+      host['active'] -= 1
+      if latency is not None:
+        slow = host['n'] >= 10 and latency > max(self.latency_factor*host['latency'], self.latency_min)
+        limit = host['limit']
+        if healthy and not slow:
+          host['limit'] = min(self.max_per_host, limit + 1/limit)
+        else:
+          host['limit'] = max(1, limit/2)
+          if host['limit'] != limit:
+            logger.debug(f"  {netloc} concurrency limit {limit:.2f} => {host['limit']:.2f}")
+        if host['latency'] is None:
+          host['latency'] = latency
+        else:
+          host['latency'] = 0.9*host['latency'] + 0.1*latency
+        host['n'] += 1
+      host['condition'].notify_all()
+
+  def request(self, method, url, session=None, retries=None, **kwargs):
+    """Same as session.request(method, url, **kwargs), with throttling, retries,
+    and a timeout. If session is None, requests.request is used.
+
+    Returns the last response, which may have a status in retry_codes, or
+    raises the last exception if all tries failed.
+    """
+
+    if retries is None:
+      retries = self.retries
+    kwargs.setdefault('timeout', self.timeout)
+    netloc = urlparse(url).netloc
+    host = self.host(url)
+
+    for attempt in range(retries + 1):
+      self.acquire(host)
+      start = time.time()
+      resp = None
+      error = None
+      try:
+        resp = (session or requests).request(method, url, **kwargs)
+      except self.retry_exceptions as e:
+        error = e
+      finally:
+        healthy = resp is not None and resp.status_code not in self.retry_codes
+        # Responses from a cache say nothing about the host.
+        latency = None if getattr(resp, 'from_cache', False) else time.time() - start
+        self.release(host, healthy, latency, netloc)
+
+      if healthy or attempt == retries:
+        break
+
+      delay = self.backoff*2**attempt*random.uniform(0.5, 1.5)
+      if error is not None:
+        reason = type(error).__name__
+      else:
+        reason = f"HTTP status {resp.status_code}"
+        retry_after = resp.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+          delay = max(delay, int(retry_after))
+        resp.close()
+      logger.warning(f"  {reason}; retry {attempt + 1}/{retries} in {delay:.2f} [s]: {url}")
+      time.sleep(delay)
+
+    if resp is None:
+      raise error
+    return resp
+
+# Sessions for /data requests by server URL; see data_session().
+data_sessions = {}
+data_sessions_lock = threading.Lock()
+
+def data_session(server_url):
+  """Return the requests.Session for /data requests to server_url.
+
+  One session per server is shared by all threads so that connections are
+  kept alive and reused across datasets and chunks; only get() is used, which
+  is safe across threads because urllib3 connection pools are. At most
+  pool_size idle connections are kept.
+  """
+  with data_sessions_lock:
+    if server_url not in data_sessions:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=opts['pool_size'])
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      session.verify = False
+      if not opts['compress']:
+        session.headers['Accept-Encoding'] = 'identity'
+      data_sessions[server_url] = session
+    return data_sessions[server_url]
+
+def close_data_sessions():
+  with data_sessions_lock:
+    for session in data_sessions.values():
+      session.close()
+    data_sessions.clear()
+
+# Number of /data responses and bytes by server name; see add_transfer().
+transfer = {}
+transfer_lock = threading.Lock()
+
+def add_transfer(server_name, resp, n_bytes):
+  """Add a /data response with n_bytes decoded bytes to transfer.
+
+  Bytes on the wire are those read by urllib3 before decompression; they
+  are zero for responses from the data cache.
+  """
+  with transfer_lock:
+    stats = transfer.setdefault(server_name, {"requests": 0, "cached": 0, "bytes": 0, "wire_bytes": 0})
+    stats['requests'] += 1
+    stats['bytes'] += n_bytes
+    if getattr(resp, 'from_cache', False):
+      stats['cached'] += 1
+    else:
+      stats['wire_bytes'] += resp.raw.tell()
 
-def get_all_metadata(server_url, server_name, expire_after={"days": 1}):
+def log_transfer(opts):
+  """Log and return transfer with the number of connections opened to each server."""
+  for s in ['s1', 's2']:
+    if opts[s] not in transfer:
+      continue
+    stats = transfer[opts[s]]
+    stats['connections'] = 0
+    url = opts[f'url{s[1]}']
+    session = data_sessions.get(url, None)
+    if session is not None:
+      pool = session.get_adapter(url).poolmanager.connection_from_url(url)
+      stats['connections'] = pool.num_connections
+    ratio = stats['wire_bytes']/stats['bytes'] if stats['bytes'] > 0 else float('nan')
+    msg = f"{opts[f'{s}_padded']} /data: {stats['requests']} responses ({stats['cached']} from cache); {stats['connections']} connections; "
+    msg += f"{stats['bytes']/1e6:.3f} MB decoded; {stats['wire_bytes']/1e6:.3f} MB on the wire ({ratio:.3f} of decoded)"
+    logger.info(msg)
+  return {server_name: dict(stats) for server_name, stats in transfer.items()}
+
+# Timing spans and counters for the current run; see span() and count().
+metrics = {"spans": {}, "counters": {}}
+metrics_lock = threading.Lock()
+
+def metric_key(name, labels):
+  return json.dumps([name, labels], sort_keys=True)
+
+@contextlib.contextmanager
+def span(name, **labels):
+  """Add the time spent in the with block to span name with labels.
+
+  Spans in different threads overlap, so the sum of their times may exceed
+  the time of the run.
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    dt = time.perf_counter() - start
+    with metrics_lock:
+      key = metric_key(name, labels)
+      stats = metrics['spans'].setdefault(key, {"name": name, "labels": labels, "count": 0, "seconds": 0.0, "max": 0.0})
+      stats['count'] += 1
+      stats['seconds'] += dt
+      stats['max'] = max(stats['max'], dt)
+
+def count(name, n=1, **labels):
+  """Add n to counter name with labels."""
+  with metrics_lock:
+    key = metric_key(name, labels)
+    stats = metrics['counters'].setdefault(key, {"name": name, "labels": labels, "value": 0})
+    stats['value'] += n
+
+def counter(name, **labels):
+  return metrics['counters'].get(metric_key(name, labels), {"value": 0})['value']
+
+def metrics_summary(opts, seconds):
+  """Return spans, counters, and rates of the run, which took seconds."""
+
+  summary = {
+    "conf": opts['name'],
+    "seconds": seconds,
+    "spans": sorted(metrics['spans'].values(), key=lambda stats: -stats['seconds']),
+    "counters": list(metrics['counters'].values()),
+    "servers": {},
+    "datasets": counter('datasets'),
+    "datasets_per_second": counter('datasets')/seconds if seconds > 0 else float('nan')
+  }
+  for s in ['s1', 's2']:
+    n = counter('info_responses', server=opts[s])
+    stats = {
+      "info_responses": n,
+      "info_cache_hit_ratio": counter('info_cached', server=opts[s])/n if n > 0 else float('nan')
+    }
+    data = transfer.get(opts[s], {})
+    n = data.get('requests', 0)
+    stats['data_responses'] = n
+    stats['data_cache_hit_ratio'] = data.get('cached', 0)/n if n > 0 else float('nan')
+    stats['data_bytes'] = data.get('bytes', 0)
+    stats['data_wire_bytes'] = data.get('wire_bytes', 0)
+    summary['servers'][opts[s]] = stats
+  return summary
+
+def prometheus(summary):
+  """Format metrics_summary() in the Prometheus text exposition format."""
+
+  def labels(**kwargs):
+    kwargs = {"conf": summary['conf'], **kwargs}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in kwargs.items()) + '}'
+
+  lines = []
+  def metric(name, kind, help, values):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+    for label, value in values:
+      lines.append(f"{name}{label} {value}")
+
+  metric("compare_run_seconds", "gauge", "Time of run.",
+         [(labels(), summary['seconds'])])
+  metric("compare_span_seconds_total", "counter", "Time spent in span, summed over threads.",
+         [(labels(span=x['name'], **x['labels']), x['seconds']) for x in summary['spans']])
+  metric("compare_span_count_total", "counter", "Number of times span was entered.",
+         [(labels(span=x['name'], **x['labels']), x['count']) for x in summary['spans']])
+  metric("compare_span_max_seconds", "gauge", "Longest time spent in span.",
+         [(labels(span=x['name'], **x['labels']), x['max']) for x in summary['spans']])
+  metric("compare_events_total", "counter", "Counted events.",
+         [(labels(event=x['name'], **x['labels']), x['value']) for x in summary['counters']])
+  values = []
+  for server, stats in summary['servers'].items():
+    for kind in ['info', 'data']:
+      values.append((labels(server=server, endpoint=kind), stats[f'{kind}_cache_hit_ratio']))
+  metric("compare_cache_hit_ratio", "gauge", "Fraction of responses from cache.", values)
+  values = []
+  for server, stats in summary['servers'].items():
+    values.append((labels(server=server, encoding="decoded"), stats['data_bytes']))
+    values.append((labels(server=server, encoding="wire"), stats['data_wire_bytes']))
+  metric("compare_data_bytes_total", "counter", "Bytes of /data responses.", values)
+  metric("compare_datasets_per_second", "gauge", "Datasets compared per second of run.",
+         [(labels(), summary['datasets_per_second'])])
+
+  return '\n'.join(lines).replace(' nan', ' NaN') + '\n'
+
+def write_metrics(summary, opts):
+  """Write summary to data_dir/metrics.{conf}.json or .prom and log the slowest spans.
+
+  The .prom file is written to a temporary file and renamed so that a
+  node_exporter textfile collector never reads a partial file.
+  """
+
+  logger.info(f"Run time = {summary['seconds']:.3f} [s]; {summary['datasets']} datasets ({summary['datasets_per_second']:.3f}/s)")
+  for stats in summary['spans'][0:10]:
+    labels = ''.join(f" {v}" for v in stats['labels'].values())
+    logger.info(f"  {stats['name']}{labels}: {stats['count']} x; total = {stats['seconds']:.3f} [s]; max = {stats['max']:.3f} [s]")
+  for server, stats in summary['servers'].items():
+    logger.info(f"  {server} cache hit ratio: /info = {stats['info_cache_hit_ratio']:.3f}; /data = {stats['data_cache_hit_ratio']:.3f}")
+
+  if opts['metrics'] is None:
+    return
+  ext = 'json' if opts['metrics'] == 'json' else 'prom'
+  fname = os.path.join(opts['data_dir'], f"metrics.{opts['name']}.{ext}")
+  with open(fname + '.tmp', 'w', encoding='utf-8') as f:
+    if ext == 'json':
+      json.dump(summary, f, indent=2)
+    else:
+      f.write(prometheus(summary))
+  os.replace(fname + '.tmp', fname)
+  logger.info(f"Wrote {fname}")
+
+def write_profile(profiler, opts, n=20):
+  """Write cProfile stats to data_dir/profile.{conf}.prof and log the top n."""
+
+  import io
+  import pstats
+
+  fname = os.path.join(opts['data_dir'], f"profile.{opts['name']}.prof")
+  profiler.dump_stats(fname)
+  logger.info(f"Wrote {fname}; view with, e.g., python -m pstats {fname}")
+  stream = io.StringIO()
+  pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(n)
+  for line in stream.getvalue().splitlines():
+    if line.strip() != '':
+      logger.info(f"  {line}")
+
+class DataCache:
+  """Compressed on-disk cache of /data responses with a total size limit.
+
+  Responses with status 200 are stored zlib-compressed in a SQLite table
+  keyed by URL, which has the server, dataset, parameters, time range, and
+  format. When the total compressed size exceeds max_size bytes, the least
+  recently used responses are removed.
+  """
+
+  def __init__(self, fname, max_size):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    # One connection shared by threads; access is serialized by self.lock.
+    self.db = sqlite3.connect(fname, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                    "(url TEXT PRIMARY KEY, headers TEXT, body BLOB, size INTEGER, created REAL, accessed REAL)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+    # In case max_size is less than in a previous run.
+    n = self.evict()
+    if n > 0:
+      logger.info(f"Removed {n} least recently used responses from data cache to reduce it to {max_size/1e6} MB")
+
+  def get(self, url, expire_after):
+    """Return cached response for url if younger than expire_after, else None."""
+    with self.lock:
+      row = self.db.execute("SELECT headers, body, created FROM responses WHERE url = ?", (url,)).fetchone()
+      if row is None:
+        return None
+      if time.time() - row[2] > datetime.timedelta(**expire_after).total_seconds():
+        self.db.execute("DELETE FROM responses WHERE url = ?", (url,))
+        return None
+      self.db.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), url))
+
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.url = url
+    resp.headers = requests.structures.CaseInsensitiveDict(json.loads(row[0]))
+    resp._content = zlib.decompress(row[1])
+    resp._content_consumed = True
+    resp.from_cache = True
+    return resp
+
+  def put(self, url, resp):
+    # Level 1 because responses can be large and speed matters more than size.
+    body = zlib.compress(resp.content, 1)
+    # The stored body is decoded, so headers that describe the encoding are dropped.
+    drop = ['content-encoding', 'content-length', 'transfer-encoding']
+    headers = {k: v for k, v in resp.headers.items() if k.lower() not in drop}
+    with self.lock:
+      now = time.time()
+      self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                      (url, json.dumps(headers), body, len(body), now, now))
+      n = self.evict()
+    if n > 0:
+      logger.debug(f"Removed {n} least recently used responses from data cache")
+
+  def evict(self):
+    """Remove least recently used responses until the total size is at most
+    max_size and return the number removed."""
+    size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if size <= self.max_size:
+      return 0
+    urls = []
+    for url, n_bytes in self.db.execute("SELECT url, size FROM responses ORDER BY accessed"):
+      if size <= self.max_size:
+        break
+      urls.append((url,))
+      size -= n_bytes
+    self.db.executemany("DELETE FROM responses WHERE url = ?", urls)
+    return len(urls)
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+# Set by Comparator.run() if s1_data_expire_after or s2_data_expire_after is
+# not None.
+data_cache = None
+
+def server_dir(url):
+  url_parts = urlparse(url)
+  url_dir = os.path.join(opts['data_dir'], 'CachedSession', 'compare', url_parts.netloc, *url_parts.path.split('/'))
+  os.makedirs(url_dir, exist_ok=True)
+  return url_dir
+
+def CachedSession(server_url, expire_after):
+  """Create a requests_cache session for server_url.
+
+  With cache_backend = 'sqlite' (the default), all responses for a server are
+  stored in one indexed file, {server_dir}/http_cache.sqlite. Any other
+  requests_cache backend name, e.g., 'filesystem', may be used.
+  """
 
   if expire_after is None:
     expire_after = {"days": 0}
 
-  # Could do these in parallel.
-
-  def server_dir(url):
-    url_parts = urlparse(url)
-    url_dir = os.path.join(opts['data_dir'], 'CachedSession', 'compare', url_parts.netloc, *url_parts.path.split('/'))
-    os.makedirs(url_dir, exist_ok=True)
-    return url_dir
+  cache_dir = server_dir(server_url)
+  cache_name = cache_dir
+  if opts['cache_backend'] == 'sqlite':
+    cache_name = os.path.join(cache_dir, 'http_cache')
+
+  # https://requests-cache.readthedocs.io/en/stable/#settings
+  # https://requests-cache.readthedocs.io/en/stable/user_guide/headers.html
+  copts = {
+    "cache_control": True,                # Use Cache-Control response headers for expiration, if available
+    "expire_after": datetime.timedelta(**expire_after), # Otherwise expire after this
+    "allowable_codes": [200],             # Cache responses with these status codes
+    "stale_if_error": False,              # In case of request errors, use stale cache data if possible
+    "backend": opts['cache_backend']
+  }
+  import requests_cache
+  return requests_cache.CachedSession(cache_name, **copts)
+
+def info_url(server_url, id):
+  # URL as it appears in the cache, i.e., after normalization by requests.
+  return requests.Request('GET', server_url + '/info?id=' + id).prepare().url
+
+def cached_infos(session, server_url, ids=None):
+  """Return dict of unexpired cached /info responses for server_url.
+
+  Keys are response URLs. If ids is given, only the responses for those
+  dataset IDs are looked up, by cache key. Otherwise, all responses in the
+  cache are read and decoded to find those for server_url.
+  """
+  responses = {}
+  if ids is not None:
+    for id in ids:
+      request = session.prepare_request(requests.Request('GET', info_url(server_url, id)))
+      # verify=False as in get_all_metadata(); it is part of the key.
+      resp = session.cache.get_response(session.cache.create_key(request, verify=False))
+      if resp is not None and not resp.is_expired:
+        responses[resp.url] = resp
+    return responses
+
+  prefix = info_url(server_url, '')
+  for resp in session.cache.filter(valid=True, expired=False):
+    if resp.url.startswith(prefix):
+      responses[resp.url] = resp
+  return responses
+
+def get_all_metadata(server_url, server_name, expire_after={"days": 1}, workers=1):
 
   if not server_url.startswith('http'):
     logger.info(f"Reading: {server_url}")
-    with open(server_url, 'r', encoding='utf-8') as f:
+    with span('cache_load', server=server_name), open(server_url, 'r', encoding='utf-8') as f:
       datasets = json.load(f)
     logger.info(f"Read: {server_url}")
     return datasets
 
   cache_dir = server_dir(server_url)
-  logger.info("Getting catalog and info metadata")
-
-  def CachedSession():
-    # https://requests-cache.readthedocs.io/en/stable/#settings
-    # https://requests-cache.readthedocs.io/en/stable/user_guide/headers.html
-    copts = {
-      "cache_control": True,                # Use Cache-Control response headers for expiration, if available
-      "expire_after": datetime.timedelta(**expire_after), # Otherwise expire after this
-      "allowable_codes": [200],             # Cache responses with these status codes
-      "stale_if_error": False,              # In case of request errors, use stale cache data if possible
-      "backend": "filesystem"
-    }
-    return requests_cache.CachedSession(cache_dir, **copts)
+  logger.info(f"Getting {server_name} catalog and info metadata using {workers} worker(s)")
 
-  session = CachedSession()
+  # A requests.Session is not guaranteed to be thread-safe, so each worker
+  # thread gets its own session. All sessions share the same cache.
+  local = threading.local()
+  def session():
+    if not hasattr(local, 'session'):
+      local.session = CachedSession(server_url, expire_after)
+    return local.session
 
   urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-  resp = session.request('get', server_url + '/catalog', verify=False)
-  datasets = resp.json()['catalog']
+  with span('catalog', server=server_name):
+    resp = scheduler.request('get', server_url + '/catalog', session=session(), verify=False)
+    datasets = resp.json()['catalog']
 
-  for dataset in datasets:
-    id = dataset['id']
-    if omit(id):
-      continue
+  datasets_keep = [dataset for dataset in datasets if not omit(dataset['id'])]
 
+  start = time.time()
+  with span('cache_load', server=server_name):
+    cached = cached_infos(session(), server_url, ids=[dataset['id'] for dataset in datasets_keep])
+  dt = "{0:.6f}".format(time.time() - start)
+  logger.info(f'  Read {len(cached)} cached {server_name} /info responses (time = {dt} [s])')
+
+  def get_info(dataset):
+    id = dataset['id']
     url = server_url + '/info?id=' + id
 
-    start = time.time()
-    logger.info(f'  Getting {server_name}: {url}')
-    resp = session.request('get', url, verify=False)
-    if resp.from_cache:
+    resp = cached.get(info_url(server_url, id), None)
+    if resp is not None:
       logger.info(f'  Got: (from cache) {url}')
-      file_cache = os.path.join(cache_dir, resp.cache_key + ".json")
-      logger.info(f'  Cache file: {file_cache}')
+      count('info_cached', server=server_name)
     else:
-      dt = "{0:.6f}".format(time.time() - start)
-      logger.info(f'  Got: (time = {dt} [s]) {url}')
+      start = time.time()
+      logger.info(f'  Getting {server_name}: {url}')
+      try:
+        with span('info', server=server_name):
+          resp = scheduler.request('get', url, session=session(), verify=False)
+      except requests.RequestException as e:
+        logger.error(f'  {server_name} {type(e).__name__}: {url}')
+        return
+      if resp.from_cache:
+        count('info_cached', server=server_name)
+        logger.info(f'  Got: (from cache) {url}')
+        if opts['cache_backend'] == 'filesystem':
+          file_cache = os.path.join(cache_dir, resp.cache_key + ".json")
+          logger.info(f'  Cache file: {file_cache}')
+      else:
+        dt = "{0:.6f}".format(time.time() - start)
+        logger.info(f'  Got: (time = {dt} [s]) {url}')
 
+    count('info_responses', server=server_name)
     if resp.status_code != 200:
-      continue
+      logger.error(f'  {server_name} HTTP status = {resp.status_code}: {url}')
+      return
 
+    # Datasets are modified in place so catalog order is preserved
+    # regardless of the order in which responses arrive.
     dataset['info'] = resp.json()
     del dataset['info']['status']
     del dataset['info']['HAPI']
 
+  if workers > 1:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      list(pool.map(get_info, datasets_keep))
+  else:
+    for dataset in datasets_keep:
+      get_info(dataset)
+
   return datasets
 
+def prune_cache(server_url, server_name, expire_after={"days": 1}):
+  """Remove expired responses and /info responses for datasets not in /catalog."""
+
+  if not server_url.startswith('http'):
+    return
+
+  session = CachedSession(server_url, expire_after)
+  n_before = len(session.cache.responses)
+  session.cache.delete(expired=True)
+
+  urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+  # Use the current catalog, not a cached one, to find orphans.
+  resp = scheduler.request('get', server_url + '/catalog', session=session, verify=False, force_refresh=True)
+  ids = [dataset['id'] for dataset in resp.json()['catalog']]
+  urls = set(info_url(server_url, id) for id in ids)
+
+  orphans = []
+  for url, resp in cached_infos(session, server_url).items():
+    if url not in urls:
+      orphans.append(resp.cache_key)
+  if len(orphans) > 0:
+    session.cache.delete(*orphans)
+
+  n_after = len(session.cache.responses)
+  logger.info(f"Pruned {server_name} cache: {n_before} responses before; {n_after} after; {len(orphans)} orphaned /info responses")
+
+def snapshot_files(server_url):
+  # By URL b/c configurations may use the same server name for different URLs.
+  # Not in server_dir() b/c that is the directory of the filesystem backend
+  # of requests_cache, which reads all files in it as cached responses.
+  url_parts = urlparse(server_url)
+  base = os.path.join(opts['data_dir'], 'cache', 'snapshots', url_parts.netloc, *url_parts.path.split('/'), 'catalog-all')
+  return base + '.jsonl', base + '.index.json'
+
+def read_snapshot(server_url):
+  """Read datasets that are not omitted from a catalog snapshot.
+
+  The snapshot is a JSON-lines file with one dataset per line and an index
+  file. The index has catalog, the IDs in the catalog, and datasets, the byte
+  offset, length, and MD5 of each dataset's line, in catalog order, or None
+  if its /info request failed. Only lines for datasets that are not omitted
+  are read. Returns None if there is no snapshot or if the snapshot was
+  written by runs that omitted datasets that are not omitted in this run,
+  e.g., a run with --id.
+  """
+  fname, fname_index = snapshot_files(server_url)
+  if not os.path.exists(fname) or not os.path.exists(fname_index):
+    return None
+
+  with open(fname_index, 'r', encoding='utf-8') as f:
+    index = json.load(f)
+  if not isinstance(index.get('datasets', None), dict):
+    logger.info(f"Not using {fname} b/c it was written by a previous version")
+    return None
+
+  missing = [id for id in index['catalog'] if id not in index['datasets'] and not omit(id)]
+  if len(missing) > 0:
+    logger.info(f"Not using {fname} b/c it does not have {len(missing)} datasets to compare, e.g., {missing[0]}")
+    return None
+
+  datasets = []
+  with open(fname, 'rb') as f:
+    for id, entry in index['datasets'].items():
+      if entry is None or omit(id):
+        continue
+      f.seek(entry[0])
+      datasets.append(json.loads(f.read(entry[1])))
+
+  logger.info(f"Read {len(datasets)} of {len(index['catalog'])} datasets from {fname}")
+  return datasets
+
+def write_snapshot(server_url, datasets):
+  """Append new and changed datasets to the catalog snapshot.
+
+  Datasets that are unchanged keep their existing line. Entries for datasets
+  that were omitted in this run are kept; datasets that were omitted in this
+  run and have no entry are not in the snapshot, which read_snapshot() uses
+  to decide if the snapshot has the datasets of a run. The data file is
+  rewritten without unused lines only when more than half of it is unused.
+  """
+  fname, fname_index = snapshot_files(server_url)
+  os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+  index_last = {}
+  size = 0
+  if os.path.exists(fname) and os.path.exists(fname_index):
+    with open(fname_index, 'r', encoding='utf-8') as f:
+      index_last = json.load(f).get('datasets', None)
+    if isinstance(index_last, dict):
+      size = os.path.getsize(fname)
+    else:
+      # Index written by a previous version
+      index_last = {}
+
+  index = {}
+  n_appended = 0
+  with open(fname, 'ab' if size > 0 else 'wb') as f:
+    for dataset in datasets:
+      id = dataset['id']
+      if 'info' not in dataset:
+        if not omit(id):
+          # /info request failed
+          index[id] = None
+        elif id in index_last:
+          index[id] = index_last[id]
+        continue
+      line = json.dumps(dataset).encode('utf-8')
+      digest = hashlib.md5(line).hexdigest()
+      if index_last.get(id, None) is not None and index_last[id][2] == digest:
+        index[id] = index_last[id]
+        continue
+      f.write(line + b'\n')
+      index[id] = [size, len(line), digest]
+      size += len(line) + 1
+      n_appended += 1
+
+  n_used = sum(entry[1] + 1 for entry in index.values() if entry is not None)
+  if size > 2*n_used:
+    with open(fname, 'rb') as f, open(fname + '.tmp', 'wb') as f_tmp:
+      offset = 0
+      for id, entry in index.items():
+        if entry is None:
+          continue
+        offset_last, length, digest = entry
+        f.seek(offset_last)
+        f_tmp.write(f.read(length + 1))
+        index[id] = [offset, length, digest]
+        offset += length + 1
+    os.replace(fname + '.tmp', fname)
+    logger.info(f"Compacted {fname}")
+
+  # Write index last and atomically so that a partial write of the data file
+  # does not invalidate the previous snapshot.
+  with open(fname_index + '.tmp', 'w', encoding='utf-8') as f:
+    json.dump({"catalog": [dataset['id'] for dataset in datasets], "datasets": index}, f)
+  os.replace(fname_index + '.tmp', fname_index)
+
+  logger.info(f"Wrote {n_appended} new or changed datasets to {fname}")
+
 def restructure(datasets, svr):
-  """Create _parameters dict with keys of parameter name."""
+  """Create dict of datasets with keys of dataset ID.
+
+  Each info has an added _parameters dict with keys of parameter name. The
+  dataset and info dicts are shallow copies; all other objects, including
+  parameters, are those in datasets and are not copied.
+  """
   datasetsr = {}
   for dataset in datasets:
     id = dataset["id"]
@@ -550,13 +2510,103 @@ def restructure(datasets, svr):
       logger.error(f"Dataset {id} in {svr} has no info")
       continue
 
-    datasetsr[id] = copy.deepcopy(dataset)
-    datasetsr[id]["info"]["_parameters"] = {}
+    _parameters = {}
     for parameter in dataset["info"]["parameters"]:
       name = parameter["name"]
-      datasetsr[id]["info"]["_parameters"][name] = parameter
+      _parameters[name] = parameter
+    datasetsr[id] = {**dataset, "info": {**dataset["info"], "_parameters": _parameters}}
   return datasetsr
 
+@functools.lru_cache(maxsize=None)
+def compared_keys(keys):
+  # Most parameters in a catalog have one of a few sets of keys, so results
+  # are cached by the tuple of keys. The returned list must not be modified.
+  return sorted(key for key in keys if key[0:2] != 'x_')
+
+@functools.lru_cache(maxsize=None)
+def fill_float(fill):
+  try:
+    return float(fill)
+  except (TypeError, ValueError):
+    return None
+
+def normalize_parameter(parameter):
+  """Keys that are compared, sorted, and fill as a float.
+
+  fill is None if the parameter is not an int or double or its fill cannot
+  be converted to a float.
+  """
+  fill = None
+  if parameter.get('type', None) in ['int', 'double'] and isinstance(parameter.get('fill', None), (str, int, float)):
+    fill = fill_float(parameter['fill'])
+  return {"keys": compared_keys(tuple(parameter.keys())), "fill": fill}
+
+def parse_dates(times):
+  """Return dict of datetimes for the list of HAPI time strings times.
+
+  Times with the same format (e.g., YYYY-MM-DDZ or YYYY-DOYTHH:MMZ) are
+  parsed by one call to hapitime2datetime(). Values are None for times that
+  could not be parsed.
+  """
+  import re
+  formats = {}
+  for t in set(times):
+    formats.setdefault(re.sub(r'\d', '0', t), []).append(t)
+
+  dates = {}
+  for group in formats.values():
+    try:
+      dates.update(zip(group, hapitime2datetime(group)))
+    except Exception:
+      dates.update({t: None for t in group})
+  return dates
+
+def normalize(datasets, s, opts):
+  """Add _normalized to each info of datasets returned by restructure().
+
+  _normalized has the info keys that are compared, the datetime of each info
+  key that ends in Date, and the normalize_parameter() result for each
+  parameter, in order. All dates are parsed in one pass over the catalog so
+  compare_info() and compare_parameter() only compare values.
+  """
+  times = []
+  for dsid in datasets.keys():
+    info = datasets[dsid]["info"]
+    for key in info.keys():
+      if key.endswith('Date') and isinstance(info[key], str) and info[key] != '':
+        times.append(info[key])
+  dates = parse_dates(times)
+
+  for dsid in datasets.keys():
+    info = datasets[dsid]["info"]
+    info["_normalized"] = {
+      "keys": remove_keys(list(info.keys()), s, opts),
+      "dates": {key: dates.get(info[key], None) for key in info.keys() if key.endswith('Date') and isinstance(info[key], str)},
+      "parameters": [normalize_parameter(parameter) for parameter in info["parameters"]]
+    }
+  return datasets
+
+def info_hash(info, s, opts):
+  """Hash of the parts of info that are compared.
+
+  Keys removed by remove_keys() and parameter keys that start with "x_" are
+  not included. Two datasets with the same hash have no /info differences.
+  """
+  keys = remove_keys(list(info.keys()), s, opts)
+  canonical = {key: info[key] for key in keys}
+  canonical['parameters'] = []
+  for parameter in info['parameters']:
+    parameter = {k: v for k, v in parameter.items() if not k.startswith("x_")}
+    canonical['parameters'].append(parameter)
+  canonical = json.dumps(canonical, sort_keys=True, separators=(',', ':'), default=str)
+  return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def add_hashes(datasets, s, opts):
+  """Add _hash to each dataset returned by restructure()."""
+  for dsid in datasets.keys():
+    datasets[dsid]["_hash"] = info_hash(datasets[dsid]["info"], s, opts)
+  return datasets
+
 def pad_server_name(opts):
   l1 = len(opts['s1'])
   l2 = len(opts['s2'])
@@ -569,66 +2619,303 @@ def pad_server_name(opts):
 
   return opts
 
-# Read configuration
-fname = os.path.join(os.path.dirname(__file__), 'compare.json')
-config = utilrsw.read(fname)
-
-# Read command line arguments
-args = cli(config)
-opts = config[args['conf']]
-opts['data_dir'] = args['data_dir']
-opts.update(args)
-
-logger = _logger(args['log_level'], args['data_dir'], args['conf'])
-logger.info(f"Logging output to {opts['data_dir']}")
-logger.info(f"Cache directory: {opts['data_dir']}")
-
-opts = pad_server_name(opts)
-
-if opts['include']:
-  logger.warning("--include is deprecated. Use --id")
-  opts['id'] = opts['include']
-
-if opts['mode'] == 'update':
-  msg = "--mode = 'update'; Backward compatible differences will be treated as warnings."
-  logger.info(msg)
-
-if opts['mode'] == 'update':
-  logger.info("Original server")
-logger.info(f"  {opts['s1']} = {opts['url1']}")
-
-if opts['mode'] == 'update':
-  logger.info("Updated server")
-logger.info(f"  {opts['s2']} = {opts['url2']}")
-
-cache1 = f"{opts['data_dir']}/cache/catalog-all.{opts['s1']}.pkl"
-cache2 = f"{opts['data_dir']}/cache/catalog-all.{opts['s2']}.pkl"
-
-if opts['id'] is None and opts['s1_expire_after'] is None and os.path.exists(cache1):
-  datasets_s1o = utilrsw.read(cache1, logger=logger)
-else:
-  datasets_s1o = get_all_metadata(opts['url1'], opts['s1'], expire_after=opts['s1_expire_after'])
-
-if opts['id'] is None and opts['s2_expire_after'] is None and os.path.exists(cache2):
-  datasets_s2o = utilrsw.read(cache2, logger=logger)
-else:
-  datasets_s2o = get_all_metadata(opts['url2'], opts['s2'], expire_after=opts['s2_expire_after'])
-
-if opts['id'] is None:
-  utilrsw.write(cache1, datasets_s1o, logger=logger)
-  utilrsw.write(cache2, datasets_s2o, logger=logger)
-
-logger.info("")
-
-if False:
-  if {} == deepdiff.DeepDiff(datasets_s1o, datasets_s2o):
-    # Check to see if we abort metadata checks early.
-    # Takes a long time for large catalogs.
-    logger.info("All /info metadata is the same.")
-    if opts['compare_data'] is False:
-      exit(0)
+def read_metadata(s):
+  i = s[1]
+  datasets = None
+  # Shards use the snapshot written by --prepare so that each does not get
+  # the catalog and all shards compare the same metadata.
+  if opts[f'{s}_expire_after'] is None or opts['shard'] is not None:
+    with span('cache_load', server=opts[s]):
+      datasets = read_snapshot(opts[f'url{i}'])
+  if datasets is None:
+    if opts['shard'] is not None:
+      logger.warning(f"No {opts[s]} catalog snapshot with the datasets of this shard; getting metadata for this shard only. Use --prepare before running shards.")
+    datasets = get_all_metadata(opts[f'url{i}'], opts[s],
+                                expire_after=opts[f'{s}_expire_after'],
+                                workers=opts[f'{s}_workers'])
+    if opts['shard'] is None:
+      # Shards running at the same time would overwrite each other's snapshot.
+      write_snapshot(opts[f'url{i}'], datasets)
+  return datasets
 
-datasets_s1 = restructure(datasets_s1o, opts['s1'])
-datasets_s2 = restructure(datasets_s2o, opts['s2'])
+# Datasets from prepare_metadata() by server URL, --id, --shard, and omits.
+# Set by Comparator.run() to the catalogs passed to Comparator, so that a
+# server used by more than one Comparator given the same dict, e.g., those of
+# one command, is loaded once.
+catalogs = {}
+
+def prepare_metadata(s):
+  """Return datasets of server s after read_metadata(), restructure(),
+  normalize(), and add_hashes().
+
+  The returned datasets are shared with other comparisons and must not be
+  modified.
+  """
+  key = json.dumps([opts[f'url{s[1]}'], opts['id'], opts['shard'], opts.get(f'{s}_omits', None)])
+  if key in catalogs:
+    logger.info(f"Using {opts[s]} metadata from {opts[f'url{s[1]}']} loaded for a previous comparison")
+    return catalogs[key]
+
+  datasets = read_metadata(s)
+  with span('restructure', server=opts[s]):
+    datasets = restructure(datasets, opts[s])
+  with span('normalize', server=opts[s]):
+    datasets = normalize(datasets, s, opts)
+  with span('add_hashes', server=opts[s]):
+    datasets = add_hashes(datasets, s, opts)
+  catalogs[key] = datasets
+  return datasets
 
-compare_metadata(datasets_s1, datasets_s2, opts)
+# Results of --benchmark; see benchmark_chunk().
+benchmark_results = []
+
+# Replaced by Comparator.run() by one with options from compare.json and
+# command line.
+scheduler = HostScheduler()
+
+class Comparator:
+  """Compare the metadata and, optionally, data of two HAPI servers.
+
+  Example:
+
+    import compare
+    comparator = compare.Comparator('SSCWeb', id='^ace$', compare_data=False)
+    results = comparator.run()
+
+  conf is a key in config, which has the form of compare.json and is read
+  from compare.json if None. Keyword arguments are options with the names of
+  the command line options (with hyphens replaced by underscores), e.g.,
+  log_level='error' and s1_workers=8. Options that are not given or are None
+  have the value in config[conf] or, if not in config[conf], the default.
+
+  The comparison functions in this module use module-level opts, args,
+  logger, and scheduler, which run() sets, so two Comparators in the same
+  process cannot run at the same time. Comparators run one after the other
+  that are given the same catalogs dict share server metadata; see
+  prepare_metadata(). If catalogs is None, metadata is loaded on each run().
+  """
+
+  def __init__(self, conf, config=None, catalogs=None, **options):
+    if config is None:
+      fname = os.path.join(os.path.dirname(__file__), 'compare.json')
+      config = utilrsw.read(fname)
+
+    # Command line defaults for options not given.
+    args = cli(config, argv=[])
+    args['conf'] = conf
+    args.update(options)
+
+    if args['conf'] == 'CDAWeb-metadata' and args['compare_data']:
+      raise ValueError("CDAWeb-metadata does not support comparing data.")
+
+    if args['debug']:
+      args['log_level'] = 'debug'
+
+    args['data_dir'] = os.path.abspath(args['data_dir'])
+
+    opts = dict(config[args['conf']])
+    opts['data_dir'] = args['data_dir']
+    # Options that are not given on the command line (value of None) do not
+    # override the value in compare.json.
+    opts.update({k: v for k, v in args.items() if v is not None or k not in opts})
+    defaults = {
+      "s1_workers": 1,
+      "s2_workers": 1,
+      "stream": False,
+      "data_mode": "exact",
+      "data_format": "csv",
+      "rtol": 1e-7,
+      "atol": 0.0,
+      "jobs": 1,
+      "sample_windows": 1,
+      "sample_duration": {"days": 1},
+      "chunk_duration": None,
+      "chunk_workers": 4,
+      "benchmark": 0,
+      "load": None,
+      "load_requests": None,
+      "load_duration": 10,
+      "incremental": False,
+      "findings": True,
+      "timeout": 60,
+      "retries": 3,
+      "max_per_host": 8,
+      "pool_size": 10,
+      "compress": True,
+      "s1_data_expire_after": None,
+      "s2_data_expire_after": None,
+      "data_cache_size": 1000,
+      "metrics": None,
+      "profile": False,
+      "shard": None,
+      "cache_backend": "sqlite"
+    }
+    for k, v in defaults.items():
+      if opts.get(k, None) is None:
+        opts[k] = v
+    if args['no_findings']:
+      opts['findings'] = False
+    if args['no_compress']:
+      opts['compress'] = False
+
+    if isinstance(opts['load'], str):
+      opts['load'] = [int(concurrency) for concurrency in opts['load'].split(',')]
+
+    if opts['benchmark'] > 0:
+      opts['compare_data'] = True
+
+    # Output files of a shard have names that include the shard so that
+    # shards can write to the same data_dir.
+    opts['name'] = opts['conf']
+    if isinstance(opts['shard'], str):
+      msg = f"shard = '{opts['shard']}' is not of the form i/N with 1 <= i <= N"
+      try:
+        opts['shard'] = [int(n) for n in opts['shard'].split('/')]
+      except ValueError:
+        raise ValueError(msg)
+      if len(opts['shard']) != 2 or not 1 <= opts['shard'][0] <= opts['shard'][1]:
+        raise ValueError(msg)
+    if opts['shard'] is not None:
+      opts['name'] = shard_name(opts['conf'], *opts['shard'])
+
+    self.args = args
+    self.opts = pad_server_name(opts)
+    self.catalogs = catalogs
+
+  def run(self):
+    """Run the comparison.
+
+    Returns a dict with findings, a list of the findings written to the
+    findings file (see FindingsHandler), benchmark, a list of --benchmark
+    results, load, the summary of a --load test or None, transfer, the
+    /data bytes and connections for each server (see log_transfer()), and
+    metrics, the timing spans and counters (see metrics_summary()).
+    """
+    global args, opts, logger, scheduler, data_cache, catalogs
+
+    args = self.args
+    opts = self.opts
+    catalogs = {} if self.catalogs is None else self.catalogs
+    scheduler = HostScheduler(max_per_host=opts['max_per_host'], timeout=opts['timeout'], retries=opts['retries'])
+    logger = _logger(args['log_level'], args['data_dir'], opts['name'], findings=opts['findings'])
+    data_cache = None
+    if opts['s1_data_expire_after'] is not None or opts['s2_data_expire_after'] is not None:
+      fname = os.path.join(opts['data_dir'], 'cache', 'data.sqlite')
+      data_cache = DataCache(fname, opts['data_cache_size']*1e6)
+
+    # Findings are also kept in memory for the return value. This handler is
+    # not behind the queue so that all findings are in the list when run()
+    # returns.
+    collector = FindingsHandler()
+    logger.logger.addHandler(collector)
+    results = {"findings": collector.findings, "benchmark": [], "load": None, "transfer": {}, "metrics": None}
+    metrics['spans'].clear()
+    metrics['counters'].clear()
+    profiler = None
+    if opts['profile']:
+      import cProfile
+      profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+      if profiler is None:
+        self.compare(results)
+      else:
+        profiler.runcall(self.compare, results)
+      results['metrics'] = metrics_summary(opts, time.perf_counter() - start)
+      write_metrics(results['metrics'], opts)
+      if profiler is not None:
+        write_profile(profiler, opts)
+    finally:
+      close_logger(logger.logger)
+      close_data_sessions()
+      if data_cache is not None:
+        data_cache.close()
+    results['benchmark'] = list(benchmark_results)
+
+    return results
+
+  def compare(self, results):
+
+    logger.info(f"Logging output to {opts['data_dir']}")
+    logger.info(f"Cache directory: {opts['data_dir']}")
+
+    benchmark_results.clear()
+    transfer.clear()
+
+    if opts['include']:
+      logger.warning("--include is deprecated. Use --id")
+      opts['id'] = opts['include']
+
+    if opts['mode'] == 'update':
+      msg = "--mode = 'update'; Backward compatible differences will be treated as warnings."
+      logger.info(msg)
+
+    if opts['mode'] == 'update':
+      logger.info("Original server")
+    logger.info(f"  {opts['s1']} = {opts['url1']}")
+
+    if opts['mode'] == 'update':
+      logger.info("Updated server")
+    logger.info(f"  {opts['s2']} = {opts['url2']}")
+
+    if opts['prune']:
+      for s in ['s1', 's2']:
+        prune_cache(opts[f'url{s[1]}'], opts[s], expire_after=opts[f'{s}_expire_after'])
+      return
+
+    if opts['merge'] is not None:
+      merge_findings(opts)
+      return
+
+    if opts['shard'] is not None:
+      logger.info(f"Comparing datasets in shard {opts['shard'][0]} of {opts['shard'][1]}")
+
+    if opts['s1_workers'] > 1 or opts['s2_workers'] > 1:
+      # Harvest both servers at the same time.
+      with ThreadPoolExecutor(max_workers=2) as pool:
+        datasets_s1, datasets_s2 = pool.map(prepare_metadata, ['s1', 's2'])
+    else:
+      datasets_s1 = prepare_metadata('s1')
+      datasets_s2 = prepare_metadata('s2')
+
+    logger.info("")
+
+    if opts['prepare']:
+      logger.info("Wrote catalog snapshots for --shard runs")
+      return
+
+    if opts['load'] is not None:
+      results['load'] = load_test(datasets_s1, datasets_s2, opts)
+      return
+
+    hashes_s1 = {dsid: dataset["_hash"] for dsid, dataset in datasets_s1.items()}
+    hashes_s2 = {dsid: dataset["_hash"] for dsid, dataset in datasets_s2.items()}
+    if hashes_s1 == hashes_s2:
+      # No early return b/c compare_dataset() checks bins references even if
+      # the /info responses are the same. It skips the other /info checks.
+      logger.info("All /info metadata is the same.")
+
+    # Includes compare_data() if compare_data is True.
+    with span('compare_metadata'):
+      compare_metadata(datasets_s1, datasets_s2, opts)
+
+    if opts['compare_data']:
+      results['transfer'] = log_transfer(opts)
+
+    if opts['benchmark'] > 0:
+      write_benchmark(opts)
+
+def main():
+  # Read configuration
+  fname = os.path.join(os.path.dirname(__file__), 'compare.json')
+  config = utilrsw.read(fname)
+
+  # Read command line arguments
+  args = cli(config)
+  # Servers used by more than one of the configurations are loaded once.
+  catalogs = {}
+  for conf in args.pop('conf'):
+    Comparator(conf, config=config, catalogs=catalogs, **args).run()
+
+if __name__ == '__main__':
+  main()
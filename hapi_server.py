@@ -0,0 +1,234 @@
+"""Synthetic HAPI server for testing and benchmarking compare.py offline.
+
+The catalog, /info, and /data responses are generated from the dataset ID,
+so two servers started with the same options return the same content except
+for datasets with injected differences. Differences are injected when
+variant != 1 for a fraction, differences, of datasets.
+
+Usage (two servers that differ in 1% of datasets):
+
+  python hapi_server.py --port 8998 --variant 1
+  python hapi_server.py --port 8999 --variant 2 --differences 0.01
+"""
+import gzip
+import json
+import zlib
+import random
+import datetime
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy
+
+defaults = {
+  "datasets": 10000,      # Number of datasets in catalog
+  "parameters": 10,       # Number of parameters in each dataset, excluding Time
+  "bins": 0.1,            # Fraction of datasets with a parameter that has bins
+  "n_bins": 100,          # Number of bins centers
+  "cadence": 60,          # Seconds between records
+  "differences": 0.01,    # Fraction of datasets with differences if variant != 1
+  "variant": 1
+}
+
+startDate = datetime.datetime(2000, 1, 1)
+stopDate = datetime.datetime(2001, 1, 1)
+
+def _rng(id, opts, salt=''):
+  # Deterministic per dataset; crc32 is used b/c hash() is randomized per process.
+  return random.Random(zlib.crc32(f'{id}{salt}'.encode('utf-8')))
+
+def _differs(id, opts):
+  if opts['variant'] == 1:
+    return False
+  return _rng(id, opts, salt=opts['variant']).random() < opts['differences']
+
+def catalog(opts):
+  return [{"id": f"DS{k:05d}"} for k in range(opts['datasets'])]
+
+def info(id, opts):
+  rng = _rng(id, opts)
+
+  parameters = [{"name": "Time", "type": "isotime", "units": "UTC", "length": 24, "fill": None}]
+  for j in range(opts['parameters']):
+    parameter = {
+      "name": f"p{j}",
+      "type": "int" if j % 5 == 4 else "double",
+      "units": rng.choice(["nT", "km", "cm^-3", "1"]),
+      "fill": "-1e31" if j % 5 != 4 else "-2147483648",
+      "description": f"Parameter {j} of {id}",
+      "x_synthetic": True
+    }
+    if j % 3 == 2:
+      parameter["size"] = [3]
+    parameters.append(parameter)
+
+  if opts['parameters'] > 0 and rng.random() < opts['bins']:
+    centers = [float(c) for c in numpy.linspace(1, 1000, opts['n_bins'])]
+    parameters[1]["size"] = [opts['n_bins']]
+    parameters[1]["bins"] = [{"name": "energy", "units": "eV", "centers": centers}]
+
+  meta = {
+    "HAPI": "3.1",
+    "status": {"code": 1200, "message": "OK"},
+    "startDate": startDate.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+    "stopDate": stopDate.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+    "cadence": f"PT{opts['cadence']}S",
+    "parameters": parameters
+  }
+
+  if _differs(id, opts) and opts['parameters'] > 0:
+    parameters[-1]["units"] = parameters[-1]["units"] + "/s"
+
+  return meta
+
+def records(id, parameters, start, stop, opts):
+  """Return structured array of records in [start, stop)."""
+
+  meta = info(id, opts)
+  all_parameters = {parameter['name']: parameter for parameter in meta['parameters']}
+  if len(parameters) == 0:
+    parameters = list(all_parameters.keys())
+  if parameters[0] != 'Time':
+    parameters = ['Time', *parameters]
+
+  cadence = numpy.timedelta64(opts['cadence'], 's')
+  start = numpy.datetime64(start.replace('Z', ''), 'ms')
+  stop = numpy.datetime64(stop.replace('Z', ''), 'ms')
+  t0 = numpy.datetime64(startDate, 'ms')
+  first = t0 + cadence*numpy.ceil((start - t0)/cadence).astype(numpy.int64)
+  times = numpy.arange(first, stop, cadence)
+  seconds = (times - t0).astype(numpy.float64)/1000
+
+  dtype = []
+  for name in parameters:
+    parameter = all_parameters[name]
+    if parameter['type'] == 'isotime':
+      base = f"S{parameter['length']}"
+    elif parameter['type'] == 'int':
+      base = '<i4'
+    else:
+      base = '<f8'
+    dtype.append((name, base, tuple(parameter.get('size', [1]))))
+
+  data = numpy.zeros(times.shape[0], dtype=dtype)
+  data['Time'][:, 0] = numpy.char.add(numpy.datetime_as_string(times, unit='ms'), 'Z').astype('S24')
+  for j, name in enumerate(parameters[1:]):
+    n = int(numpy.prod(all_parameters[name].get('size', [1])))
+    values = numpy.sin(seconds[:, None]/86400 + j + numpy.arange(n)[None, :])
+    if all_parameters[name]['type'] == 'int':
+      values = numpy.round(1000*values)
+    data[name] = values.reshape(data[name].shape)
+
+  if _differs(id, opts) and times.shape[0] > 0:
+    name = parameters[-1]
+    data[name][-1] = data[name][-1] + 1
+
+  return data
+
+def csv(data):
+  """Format structured array from records() as HAPI CSV."""
+
+  if data.shape[0] == 0:
+    return ''
+
+  columns = []
+  for name in data.dtype.names:
+    values = data[name].reshape(data.shape[0], -1)
+    for k in range(values.shape[1]):
+      if values.dtype.kind == 'S':
+        columns.append(values[:, k].astype(str))
+      elif values.dtype.kind == 'i':
+        columns.append(values[:, k].astype(str))
+      else:
+        columns.append(numpy.char.mod('%.9g', values[:, k]))
+
+  lines = columns[0]
+  for column in columns[1:]:
+    lines = numpy.char.add(numpy.char.add(lines, ','), column)
+
+  return '\n'.join(lines) + '\n'
+
+def handler(opts):
+
+  class Handler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 so that connections are kept alive.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+      pass
+
+    def send(self, body, content_type='application/json', status=200):
+      if isinstance(body, str):
+        body = body.encode('utf-8')
+      gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+      if gzipped:
+        body = gzip.compress(body, compresslevel=1)
+      self.send_response(status)
+      self.send_header('Content-Type', content_type)
+      if gzipped:
+        self.send_header('Content-Encoding', 'gzip')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      url = urlparse(self.path)
+      query = {k: v[0] for k, v in parse_qs(url.query).items()}
+      endpoint = url.path.rstrip('/').split('/')[-1]
+
+      ids = None
+      if 'id' in query:
+        if not query['id'].startswith('DS') or not query['id'][2:].isdigit() \
+            or int(query['id'][2:]) >= opts['datasets']:
+          status = {"code": 1406, "message": "HAPI error 1406: unknown dataset id"}
+          self.send(json.dumps({"HAPI": "3.1", "status": status}), status=404)
+          return
+        ids = query['id']
+
+      if endpoint == 'catalog':
+        body = {"HAPI": "3.1", "status": {"code": 1200, "message": "OK"}, "catalog": catalog(opts)}
+        self.send(json.dumps(body))
+      elif endpoint == 'info' and ids is not None:
+        self.send(json.dumps(info(ids, opts)))
+      elif endpoint == 'data' and ids is not None:
+        parameters = [p for p in query.get('parameters', '').split(',') if p != '']
+        data = records(ids, parameters, query['time.min'], query['time.max'], opts)
+        if query.get('format', 'csv') == 'binary':
+          self.send(data.tobytes(), content_type='application/octet-stream')
+        else:
+          self.send(csv(data), content_type='text/csv')
+      else:
+        status = {"code": 1400, "message": "HAPI error 1400: user input error"}
+        self.send(json.dumps({"HAPI": "3.1", "status": status}), status=400)
+
+  return Handler
+
+def start(port=0, **kwargs):
+  """Start a server in a background thread.
+
+  Returns (server, url), where url is the HAPI base URL. Use server.shutdown()
+  to stop it. kwargs override values in defaults.
+  """
+  opts = {**defaults, **kwargs}
+  server = ThreadingHTTPServer(('127.0.0.1', port), handler(opts))
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = f"http://127.0.0.1:{server.server_address[1]}/hapi"
+  return server, url
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=8999)
+  for k, v in defaults.items():
+    parser.add_argument(f'--{k.replace("_", "-")}', type=type(v), default=v)
+  args = vars(parser.parse_args())
+  port = args.pop('port')
+  server, url = start(port=port, **args)
+  print(f"Serving {url}")
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    server.shutdown()
@@ -1,7 +1,7 @@
 from setuptools import setup, find_packages
 
 install_requires = [
-    "deepdiff",
+    "numpy",
     "urllib3",
     "requests",
     "hapiclient",
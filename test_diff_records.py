@@ -0,0 +1,77 @@
+"""Test record_time() and the merge-join of data records by diff_records().
+
+Run with python -m pytest test_diff_records.py
+"""
+import logging
+
+import pytest
+
+import compare
+
+opts = {"s1": "s1", "s2": "s2", "s1_padded": "s1", "s2_padded": "s2"}
+
+@pytest.fixture
+def findings(monkeypatch):
+  logger = logging.getLogger('test_diff_records')
+  logger.setLevel(logging.ERROR)
+  logger.propagate = False
+  handler = compare.FindingsHandler()
+  logger.addHandler(handler)
+  # logger is a global set by Comparator.run().
+  monkeypatch.setattr(compare, 'logger', compare.BufferedLogger(logger), raising=False)
+  yield handler.findings
+  logger.removeHandler(handler)
+
+def records(*hours):
+  return [f"2000-01-01T{hour:02d}:00:00.000Z,{hour}" for hour in hours]
+
+def test_record_time():
+  expected = "2000-01-01T00:00:00.000000000"
+  assert compare.record_time("2000-001T00:00Z,1.0") == expected
+  assert compare.record_time("2000-01-01T00:00:00.000Z,1.0") == expected
+  assert compare.record_time('"2000-01-01T00:00:00.000Z",1.0') == expected
+  assert compare.record_time("2000-02-01T12:30:15.5Z") == "2000-02-01T12:30:15.500000000"
+  # Not a time; returned as is.
+  assert compare.record_time("fill,1.0") == "fill"
+
+def test_same(findings):
+  counts = compare.diff_records(iter(records(0, 1, 2)), iter(records(0, 1, 2)), opts)
+  assert counts == {"missing": 0, "extra": 0, "differ": 0}
+  assert findings == []
+
+def test_time_forms(findings):
+  # Same time written differently is aligned, but the records differ.
+  lines1 = ["2000-001T00:00Z,1", "2000-001T01:00Z,2"]
+  lines2 = ["2000-01-01T00:00:00.000Z,1", "2000-01-01T01:00:00.000Z,2"]
+  counts = compare.diff_records(iter(lines1), iter(lines2), opts)
+  assert counts == {"missing": 0, "extra": 0, "differ": 2}
+
+def test_missing_and_extra(findings):
+  counts = compare.diff_records(iter(records(0, 1, 2)), iter(records(0, 2, 3)), opts)
+  assert counts == {"missing": 1, "extra": 1, "differ": 0}
+
+  kinds = {finding['kind']: finding for finding in findings if finding['key'] == 'record'}
+  assert kinds['missing']['val_s1'] == records(1)[0]
+  assert kinds['missing']['val_s2'] is None
+  assert kinds['extra']['val_s1'] is None
+  assert kinds['extra']['val_s2'] == records(3)[0]
+
+  summary = [finding for finding in findings if finding['key'] == 'records']
+  assert len(summary) == 1
+  assert summary[0]['missing'] == 1
+  assert summary[0]['extra'] == 1
+
+def test_duplicate_chunk_boundary(findings):
+  # A record at the boundary of two chunks repeated by s2.
+  counts = compare.diff_records(iter(records(0, 1, 2)), iter(records(0, 1, 1, 2)), opts)
+  assert counts == {"missing": 0, "extra": 1, "differ": 0}
+  assert [finding['key'] for finding in findings] == ['record', 'records']
+  assert findings[0]['time'] == "2000-01-01T01:00:00.000000000"
+
+def test_out_of_order(findings):
+  compare.diff_records(iter(records(0, 1, 2, 3)), iter(records(0, 2, 1, 3)), opts)
+  order = [finding for finding in findings if finding['key'] == 'order']
+  assert len(order) == 1
+  assert order[0]['s'] == 's2'
+  assert order[0]['time'] == "2000-01-01T01:00:00.000000000"
+  assert order[0]['previous'] == "2000-01-01T02:00:00.000000000"
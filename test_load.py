@@ -0,0 +1,81 @@
+"""Test the load test (--load) against two local synthetic HAPI servers.
+
+Run with python -m pytest test_load.py
+"""
+import math
+
+import pytest
+
+import compare
+import hapi_server
+
+@pytest.fixture(scope="module")
+def servers():
+  opts = {"datasets": 5, "parameters": 2}
+  server1, url1 = hapi_server.start(variant=1, **opts)
+  server2, url2 = hapi_server.start(variant=2, **opts)
+  yield url1, url2
+  server1.shutdown()
+  server2.shutdown()
+
+def config(url1, url2):
+  return {
+    "local": {
+      "s1": "s1",
+      "s2": "s2",
+      "url1": url1,
+      "url2": url2,
+      "s1_expire_after": {"days": 0},
+      "s2_expire_after": {"days": 0},
+      "compare_data": False,
+      "parallel": False,
+      "warn": False,
+      "sample_duration": {"hours": 1}
+    }
+  }
+
+def test_load(servers, tmp_path):
+  url1, url2 = servers
+  comparator = compare.Comparator('local', config=config(url1, url2), load='1,4',
+                                  load_requests=20, data_dir=str(tmp_path),
+                                  log_level='error', findings=False)
+  summary = comparator.run()['load']
+
+  assert list(summary.keys()) == ['s1', 's2']
+  for server, runs in summary.items():
+    assert [run['concurrency'] for run in runs] == [1, 4]
+    for run in runs:
+      assert run['requests'] == 20
+      assert run['errors'] == 0
+      assert run['error_rate'] == 0
+      assert run['throughput'] > 0
+      latency = run['latency']
+      assert 0 < latency['p50'] <= latency['p90'] <= latency['p99']
+
+  assert (tmp_path / 'load.local.json').exists()
+
+def test_load_errors(servers, tmp_path, monkeypatch):
+  # Requests to a server that has stopped fail.
+  url1, _ = servers
+  server, url2 = hapi_server.start(variant=2, datasets=5, parameters=2)
+  comparator = compare.Comparator('local', config=config(url1, url2), load='2',
+                                  load_requests=10, data_dir=str(tmp_path),
+                                  log_level='error', findings=False, retries=0)
+
+  # Stop the second server after its metadata is read and before the load test.
+  prepare_metadata = compare.prepare_metadata
+  def prepare_metadata_and_stop(s):
+    datasets = prepare_metadata(s)
+    if s == 's2':
+      server.shutdown()
+      server.server_close()
+    return datasets
+  monkeypatch.setattr(compare, 'prepare_metadata', prepare_metadata_and_stop)
+  summary = comparator.run()['load']
+
+  assert summary['s1'][0]['errors'] == 0
+  run = summary['s2'][0]
+  assert run['requests'] == 10
+  assert run['errors'] == 10
+  assert run['error_rate'] == 1
+  assert not math.isnan(run['latency']['p50'])